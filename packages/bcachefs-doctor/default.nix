@@ -15,5 +15,6 @@ pkgs.stdenv.mkDerivation {
     pkgs.iproute2
     pkgs.findutils
     pkgs.bcachefs-tools
+    pkgs.zstd
   ];
 }
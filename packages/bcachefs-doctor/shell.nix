@@ -11,6 +11,7 @@ pkgs.mkShell {
     pkgs.iproute2
     pkgs.findutils
     pkgs.bcachefs-tools
+    pkgs.zstd
   ];
 
   # Set environment variables if needed
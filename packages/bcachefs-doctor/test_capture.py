@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Round-trip tests for --capture / --from: what a run reads while capturing
+must read back the same from the archive.
+
+Run with `python3 -m unittest` or pytest from this directory.
+"""
+
+import importlib.util
+import os
+import tarfile
+import tempfile
+import unittest
+
+_spec = importlib.util.spec_from_file_location(
+    "bcachefs_doctor", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bcachefs-doctor.py"))
+doctor = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(doctor)
+
+class CaptureRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        root = self.tmp.name
+        # dev-0/block is a symlink into the device tree, as in sysfs
+        self.disk = os.path.join(root, "sys/devices/pci0000:00/0000:00:17.0/block/sda")
+        self.dev_dir = os.path.join(root, "sys/fs/bcachefs/0f3c6a2e/dev-0")
+        os.makedirs(self.disk)
+        os.makedirs(self.dev_dir)
+        self._write(os.path.join(self.disk, "dev"), "8:0\n")
+        self._write(os.path.join(self.disk, "size"), "1953525168\n")
+        self._write(os.path.join(self.dev_dir, "label"), "hdd.hdd0\n")
+        os.symlink(self.disk, os.path.join(self.dev_dir, "block"))
+        self.archive_file = os.path.join(root, "capture.tar")
+
+    def tearDown(self):
+        doctor.CAPTURE = None
+        doctor.ARCHIVE = None
+
+    @staticmethod
+    def _write(path, content):
+        with open(path, "w") as f:
+            f.write(content)
+
+    def _capture(self, read):
+        doctor.CAPTURE = doctor.SysfsCapture()
+        try:
+            live = read()
+            capture = doctor.CAPTURE
+        finally:
+            doctor.CAPTURE = None
+        capture.write(self.archive_file, {})
+        return live
+
+    def _replay(self, read):
+        doctor.ARCHIVE = doctor.CaptureArchive(self.archive_file)
+        try:
+            return read()
+        finally:
+            doctor.ARCHIVE = None
+
+    def test_read_through_symlink(self):
+        def read():
+            # Listing dev-0 records dev-0/block as a symlink
+            doctor._scandir(self.dev_dir)
+            return (doctor.read_sysfs_attr(os.path.join(self.dev_dir, "block", "dev")),
+                    doctor.read_sysfs_attr(os.path.join(self.dev_dir, "block", "size")),
+                    doctor.read_sysfs_attr(os.path.join(self.dev_dir, "label")))
+        live = self._capture(read)
+        self.assertEqual(live, ("8:0", "1953525168", "hdd.hdd0"))
+        self.assertEqual(self._replay(read), live)
+
+    def test_listing_through_symlink(self):
+        def read():
+            names = sorted(entry.name for entry in doctor._scandir(self.dev_dir))
+            doctor.read_sysfs_attr(os.path.join(self.dev_dir, "label"))
+            return (names, doctor._isdir(os.path.join(self.dev_dir, "block")),
+                    doctor._realpath(os.path.join(self.dev_dir, "block")),
+                    doctor.read_sysfs_attr(os.path.join(self.dev_dir, "block", "dev")))
+        live = self._capture(read)
+        self.assertEqual(live, (["block", "label"], True, self.disk, "8:0"))
+        self.assertEqual(self._replay(read), live)
+
+    def test_missing_file(self):
+        missing = os.path.join(self.dev_dir, "block", "queue", "rotational")
+        self.assertIsNone(self._capture(lambda: doctor.read_sysfs_attr(missing)))
+        self.assertIsNone(self._replay(lambda: doctor.read_sysfs_attr(missing)))
+
+    def test_file_stored_under_link_path(self):
+        # Archives that stored a file under the path it was read from
+        path = os.path.join(self.dev_dir, "block", "dev")
+        with tarfile.open(self.archive_file, "w") as tar:
+            link = tarfile.TarInfo(os.path.join(self.dev_dir, "block").lstrip("/"))
+            link.type = tarfile.SYMTYPE
+            link.linkname = self.disk
+            tar.addfile(link)
+            tar.add(os.path.join(self.disk, "dev"), arcname=path.lstrip("/"))
+        self.assertEqual(self._replay(lambda: doctor.read_sysfs_attr(path)), "8:0")
+
+if __name__ == "__main__":
+    unittest.main()
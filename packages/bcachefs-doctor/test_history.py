@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Tests for the --record-history counter history.
+
+Run with `python3 -m unittest` or pytest from this directory.
+"""
+
+import importlib.util
+import os
+import tempfile
+import unittest
+
+_spec = importlib.util.spec_from_file_location(
+    "bcachefs_doctor", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bcachefs-doctor.py"))
+doctor = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(doctor)
+
+COLUMNS = ["ssd.ssd0/read/user", "ssd.ssd0/stats/io_errors"]
+
+class CounterHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.history = doctor.CounterHistory(self.tmp.name, "0f3c6a2e")
+
+    def append(self, rows, start=1000):
+        for i, values in enumerate(rows):
+            self.history.append(start + 60 * i, COLUMNS, values)
+
+    def seal(self):
+        self.history._seal(*self.history._read_tail())
+
+    def test_wrapped_and_reset_counters_survive_sealing(self):
+        rows = [[2 ** 64 - 8192, 7], [4096, 8], [2 ** 63 + 40960, 2 ** 64 - 1], [0, 0]]
+        self.append(rows)
+        self.seal()
+        (columns, values), = list(self.history.blocks())
+        self.assertEqual(columns, COLUMNS)
+        self.assertEqual(values[0], [1000, 1060, 1120, 1180])
+        self.assertEqual(values[1], [row[0] for row in rows])
+        self.assertEqual(values[2], [row[1] for row in rows])
+
+    def test_byte_counters_are_sealed_in_units(self):
+        self.append([[4095, 1], [10000, 2]])
+        self.seal()
+        (_, values), = list(self.history.blocks())
+        unit = 1 << doctor.HISTORY_BYTES_UNIT_SHIFT
+        self.assertEqual(values[1], [0, 10000 // unit * unit])
+        self.assertEqual(values[2], [1, 2])
+
+    def test_rates_across_blocks_and_tail(self):
+        self.append([[i * 1000000, i] for i in range(5)])
+        self.seal()
+        self.append([[i * 1000000, i] for i in range(5, 8)], start=1300)
+        result = self.history.rates(0, 10 ** 10)
+        self.assertEqual(result["seconds"], 420)
+        self.assertAlmostEqual(result["rates"][COLUMNS[0]], 7000000 / 420)
+        self.assertAlmostEqual(result["rates"][COLUMNS[1]], 7 / 420)
+
+if __name__ == "__main__":
+    unittest.main()
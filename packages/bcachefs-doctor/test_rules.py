@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Fixture tests for the bcachefs-doctor performance rules.
+
+Each fixture is a process_fs_info-shaped report; run with
+`python3 -m unittest` or pytest from this directory.
+"""
+
+import copy
+import importlib.util
+import json
+import os
+import unittest
+from unittest import mock
+
+_spec = importlib.util.spec_from_file_location(
+    "bcachefs_doctor", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bcachefs-doctor.py"))
+doctor = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(doctor)
+
+UUID = "0f3c6a2e-8d1b-4c55-9a7e-2b1d4e6f8a90"
+DATA_TYPES = ("sb", "journal", "btree", "user", "cached", "parity", "stripe", "need_gc_gens", "need_discard")
+
+def _device(index, label, rotational, io=1000, durability="1"):
+    """
+    One member as the host describes it: its dev-N subtree of a
+    read_sysfs_tree() snapshot and its lsblk entry. rotational is "1",
+    "0" or None for a device whose kind is unknown.
+    """
+    io_done = "".join(f"{direction}:\n" + "".join(f"{t:<20}: {io if t == 'user' else 0}\n" for t in DATA_TYPES)
+                      for direction in ("read", "write"))
+    sysfs = {
+        "label": label,
+        "io_done": io_done,
+        "options": {"durability": durability, "data_allowed": "journal,btree,user", "state": "rw",
+                    "discard": "1"},
+        "stats": {"io_errors": "0"},
+        "nbuckets": "2097152",
+        "bucket_size": "512.0 KiB"
+    }
+    lsblk = {"name": f"sd{chr(ord('a') + index)}", "model": "Test Disk", "serial": f"S{index:04d}",
+             "size": "1T", "type": "disk", "vendor": "ATA",
+             "rota": {"1": True, "0": False}.get(rotational), "maj:min": f"8:{index * 16}"}
+    return index, sysfs, lsblk
+
+def fs_devices(*members):
+    """get_fs_devices() output for members built by _device(), with lsblk and sysfs stubbed."""
+    snapshot = {f"dev-{index}": sysfs for index, sysfs, _ in members}
+    stdout = json.dumps({"blockdevices": [lsblk for _, _, lsblk in members]})
+    maj_min = {f"dev-{index}": lsblk["maj:min"] for index, _, lsblk in members}
+    
+    def run_command(cmd, timeout=None):
+        return {"stdout": stdout, "stderr": "", "returncode": 0, "success": True}
+    
+    def block_dev(path):
+        return maj_min[os.path.basename(os.path.dirname(os.path.dirname(path)))]
+    
+    doctor.get_block_device_index.cache_clear()
+    try:
+        with mock.patch.object(doctor, "run_command", run_command), \
+             mock.patch.object(doctor, "get_sysfs_file_content", block_dev), \
+             mock.patch.object(doctor, "_sysfs_rotational", lambda maj_min: None):
+            return doctor.get_fs_devices(f"/sys/fs/bcachefs/{UUID}", snapshot)
+    finally:
+        doctor.get_block_device_index.cache_clear()
+
+# Two SSDs in front of two HDDs, configured the way the rules recommend
+MEMBERS = (
+    _device(0, "ssd.ssd0", "0"),
+    _device(1, "ssd.ssd1", "0"),
+    _device(2, "hdd.hdd0", "1"),
+    _device(3, "hdd.hdd1", "1")
+)
+HEALTHY = {
+    "uuid": UUID,
+    "features": {
+        "foreground_target": "ssd",
+        "promote_target": "ssd",
+        "background_target": "hdd",
+        "metadata_replicas": "2",
+        "data_replicas": "2",
+        "journal_flush_delay": "1000"
+    },
+    "devices": fs_devices(*MEMBERS)
+}
+
+def fixture(features=None, devices=None):
+    """HEALTHY with some features overridden and/or other devices."""
+    fs_info = copy.deepcopy(HEALTHY)
+    fs_info["features"].update(features or {})
+    if devices is not None:
+        fs_info["devices"] = devices
+    return fs_info
+
+def fired(fs_info):
+    return {finding["rule"]: finding for finding in doctor.evaluate_rules(fs_info)}
+
+class HealthyTest(unittest.TestCase):
+    def test_no_findings(self):
+        self.assertEqual(doctor.evaluate_rules(fixture()), [])
+
+    def test_every_rule_is_covered(self):
+        covered = {name[len("test_"):].replace("_", "-").rsplit("-fires", 1)[0]
+                   for cls in (ForegroundOnHddTest, PromoteTargetUnsetTest, TierIoImbalanceTest,
+                               MetadataReplicasTest, ForegroundZeroDurabilityTest, JournalFlushDelayTest)
+                   for name in dir(cls) if name.endswith("_fires")}
+        self.assertEqual(covered, {rule.id for rule in doctor.RULES})
+
+class ForegroundOnHddTest(unittest.TestCase):
+    def test_foreground_on_hdd_fires(self):
+        finding = fired(fixture({"foreground_target": "hdd"}))["foreground-on-hdd"]
+        self.assertEqual(finding["severity"], "warning")
+        self.assertIn("hdd.hdd0, hdd.hdd1", finding["message"])
+        self.assertEqual(finding["fix"], f"echo ssd > /sys/fs/bcachefs/{UUID}/options/foreground_target")
+
+    def test_single_hdd_by_label(self):
+        self.assertIn("foreground-on-hdd", fired(fixture({"foreground_target": "hdd.hdd1"})))
+
+    def test_ssd_target(self):
+        self.assertNotIn("foreground-on-hdd", fired(fixture({"foreground_target": "ssd"})))
+
+    def test_no_ssd_to_move_to(self):
+        hdds = fs_devices(_device(0, "hdd.hdd0", "1"), _device(1, "hdd.hdd1", "1"))
+        self.assertNotIn("foreground-on-hdd", fired(fixture({"foreground_target": "hdd"}, hdds)))
+
+class PromoteTargetUnsetTest(unittest.TestCase):
+    def test_promote_target_unset_fires(self):
+        finding = fired(fixture({"promote_target": ""}))["promote-target-unset"]
+        self.assertIn("2 SSD device(s)", finding["message"])
+        self.assertEqual(finding["fix"], f"echo ssd > /sys/fs/bcachefs/{UUID}/options/promote_target")
+
+    def test_none(self):
+        self.assertIn("promote-target-unset", fired(fixture({"promote_target": "none"})))
+
+    def test_set(self):
+        self.assertNotIn("promote-target-unset", fired(fixture({"promote_target": "ssd"})))
+
+    def test_all_flash(self):
+        ssds = fs_devices(_device(0, "ssd.ssd0", "0"), _device(1, "ssd.ssd1", "0"))
+        features = {"promote_target": "", "background_target": "ssd"}
+        self.assertNotIn("promote-target-unset", fired(fixture(features, ssds)))
+
+    def test_kind_from_label_without_rotational_flag(self):
+        devices = fs_devices(*(_device(index, sysfs["label"], None) for index, sysfs, _ in MEMBERS))
+        self.assertIn("promote-target-unset", fired(fixture({"promote_target": ""}, devices)))
+
+    def test_kind_from_rotational_flag_with_any_labels(self):
+        devices = fs_devices(_device(0, "fast.a", "0"), _device(1, "fast.b", "0"),
+                             _device(2, "bulk.a", "1"), _device(3, "bulk.b", "1"))
+        found = fired(fixture({"foreground_target": "bulk", "promote_target": "", "background_target": "bulk"},
+                              devices))
+        self.assertIn("echo fast > ", found["promote-target-unset"]["fix"])
+        self.assertIn("bulk.a, bulk.b", found["foreground-on-hdd"]["message"])
+
+class TierIoImbalanceTest(unittest.TestCase):
+    def test_tier_io_imbalance_fires(self):
+        devices = fs_devices(*MEMBERS, _device(4, "hdd.hdd2", "1"))
+        devices[2]["io_done"] = {"read": {"user": 10000}, "write": {"user": 10000}}
+        finding = fired(fixture(devices=devices))["tier-io-imbalance"]
+        self.assertEqual(finding["severity"], "info")
+        self.assertIn("hdd.hdd0 (83% of hdd)", finding["message"])
+
+    def test_two_device_tier(self):
+        devices = fixture()["devices"]
+        devices[0]["io_done"] = {"read": {"user": 3000}, "write": {"user": 3000}}
+        finding = fired(fixture(devices=devices))["tier-io-imbalance"]
+        self.assertIn("ssd.ssd0 (75% of ssd)", finding["message"])
+        spot, = doctor.summarize_tiers(fixture(devices=devices))["ssd"]["hot_spots"]
+        self.assertEqual(spot["score"], 3.0)
+
+    def test_two_device_tier_with_idle_peer(self):
+        devices = fixture()["devices"]
+        devices[3]["io_done"] = {"read": {}, "write": {}}
+        finding = fired(fixture(devices=devices))["tier-io-imbalance"]
+        self.assertIn("hdd.hdd0 (100% of hdd)", finding["message"])
+        spot, = doctor.summarize_tiers(fixture(devices=devices))["hdd"]["hot_spots"]
+        self.assertIsNone(spot["score"])
+
+    def test_below_factor(self):
+        devices = fixture()["devices"]
+        # 1.8x the other device stays under TIER_IMBALANCE_FACTOR
+        devices[2]["io_done"] = {"read": {"user": 1800}, "write": {"user": 1800}}
+        self.assertNotIn("tier-io-imbalance", fired(fixture(devices=devices)))
+
+    def test_idle_tier(self):
+        devices = fixture()["devices"]
+        for device in devices:
+            device["io_done"] = {"read": {}, "write": {}}
+        self.assertNotIn("tier-io-imbalance", fired(fixture(devices=devices)))
+
+    def test_single_device_tier(self):
+        devices = fixture()["devices"][:3]
+        devices[2]["io_done"] = {"read": {"user": 10 ** 9}, "write": {"user": 10 ** 9}}
+        self.assertNotIn("tier-io-imbalance", fired(fixture(devices=devices)))
+
+class MetadataReplicasTest(unittest.TestCase):
+    def test_metadata_replicas_unsatisfiable_fires(self):
+        finding = fired(fixture({"metadata_replicas": "5"}))["metadata-replicas-unsatisfiable"]
+        self.assertEqual(finding["severity"], "error")
+        self.assertIn("durability 4", finding["message"])
+        self.assertIn(f"echo 4 > /sys/fs/bcachefs/{UUID}/options/metadata_replicas", finding["fix"])
+
+    def test_satisfiable(self):
+        self.assertNotIn("metadata-replicas-unsatisfiable", fired(fixture({"metadata_replicas": "4"})))
+
+    def test_btree_not_allowed_and_read_only_devices_do_not_count(self):
+        devices = fixture()["devices"]
+        devices[0]["options"]["data_allowed"] = "journal,user"
+        devices[1]["options"]["state"] = "ro"
+        devices[2]["options"]["durability"] = "0"
+        finding = fired(fixture({"metadata_replicas": "2"}, devices))["metadata-replicas-unsatisfiable"]
+        self.assertIn("durability 1", finding["message"])
+
+    def test_no_devices(self):
+        self.assertNotIn("metadata-replicas-unsatisfiable", fired(fixture({"metadata_replicas": "3"}, [])))
+
+class ForegroundZeroDurabilityTest(unittest.TestCase):
+    def test_foreground_zero_durability_fires(self):
+        devices = fixture()["devices"]
+        for device in devices[:2]:
+            device["options"]["durability"] = "0"
+        finding = fired(fixture(devices=devices))["foreground-zero-durability"]
+        self.assertIn("foreground_target 'ssd'", finding["message"])
+
+    def test_partly_durable(self):
+        devices = fixture()["devices"]
+        devices[0]["options"]["durability"] = "0"
+        self.assertNotIn("foreground-zero-durability", fired(fixture(devices=devices)))
+
+    def test_durability_defaults_to_one(self):
+        devices = fixture()["devices"]
+        for device in devices:
+            del device["options"]["durability"]
+        self.assertNotIn("foreground-zero-durability", fired(fixture(devices=devices)))
+
+class JournalFlushDelayTest(unittest.TestCase):
+    def test_journal_flush_delay_high_fires(self):
+        finding = fired(fixture({"journal_flush_delay": "5000"}))["journal-flush-delay-high"]
+        self.assertIn("5000 ms", finding["message"])
+        self.assertEqual(finding["fix"], f"echo 1000 > /sys/fs/bcachefs/{UUID}/options/journal_flush_delay")
+
+    def test_default(self):
+        self.assertNotIn("journal-flush-delay-high",
+                         fired(fixture({"journal_flush_delay": str(doctor.JOURNAL_FLUSH_DELAY_MAX_MS)})))
+
+    def test_missing(self):
+        fs_info = fixture()
+        del fs_info["features"]["journal_flush_delay"]
+        self.assertNotIn("journal-flush-delay-high", fired(fs_info))
+
+class FixtureShapeTest(unittest.TestCase):
+    def test_devices_come_from_get_fs_devices(self):
+        device = HEALTHY["devices"][2]
+        self.assertEqual(device["rotational"], "1")
+        self.assertEqual(device["name"], "sdc")
+        self.assertEqual(device["io_done"]["write"]["user"], 1000)
+        self.assertEqual(device["capacity"], 2097152 * 512 * 1024)
+
+class BlockDeviceIndexTest(unittest.TestCase):
+    def index(self, blockdevices):
+        stdout = json.dumps({"blockdevices": blockdevices})
+        doctor.get_block_device_index.cache_clear()
+        try:
+            with mock.patch.object(doctor, "run_command",
+                                   return_value={"stdout": stdout, "stderr": "", "returncode": 0, "success": True}):
+                return doctor.get_block_device_index()
+        finally:
+            doctor.get_block_device_index.cache_clear()
+
+    def test_rota_bool_and_string(self):
+        index = self.index([{"name": "sda", "rota": True, "maj:min": "8:0"},
+                            {"name": "nvme0n1", "rota": "0", "maj:min": "259:0"},
+                            {"name": "loop0", "maj:min": "7:0"}])
+        self.assertEqual([index[d]["rotational"] for d in ("8:0", "259:0", "7:0")], ["1", "0", None])
+
+    def test_partition_inherits_rota(self):
+        index = self.index([{"name": "sda", "rota": True, "maj:min": "8:0",
+                             "children": [{"name": "sda1", "maj:min": "8:1"}]}])
+        self.assertEqual(index["8:1"]["rotational"], "1")
+
+class EvaluateRulesTest(unittest.TestCase):
+    def test_failing_rule_is_reported(self):
+        def broken(ctx):
+            raise KeyError("io_done")
+        rule = doctor.Rule("broken", "warning", "", "", broken)
+        self.assertEqual(doctor.evaluate_rules(fixture(), (rule,)),
+                         [{"rule": "broken", "severity": "error", "message": "Rule failed: 'io_done'", "fix": ""}])
+
+    def test_precomputed_tiers_are_used(self):
+        fs_info = fixture()
+        fs_info["tiers"] = {"hdd": {"hot_spots": [{"label": "hdd.hdd1", "share": 0.9}]}}
+        self.assertIn("hdd.hdd1 (90% of hdd)", fired(fs_info)["tier-io-imbalance"]["message"])
+
+if __name__ == "__main__":
+    unittest.main()
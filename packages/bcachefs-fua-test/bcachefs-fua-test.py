@@ -11,21 +11,139 @@ import os
 import glob
 import subprocess
 import json
+import re
+import time
 import argparse
+import threading
 from datetime import datetime
 import sys
+import socket
+import tempfile
+from statistics import median
+from contextlib import nullcontext, redirect_stdout
 
-def get_device_details(dev_path):
+# Block queue settings reported with each device; write_cache, fua and
+# rotational explain most of the spread in FUA latencies
+QUEUE_ATTRIBUTES = ("write_cache", "fua", "rotational", "logical_block_size",
+                    "physical_block_size", "max_hw_sectors_kb", "nr_requests", "scheduler")
+
+def read_sysfs_attr(path):
+    """Stripped contents of a sysfs attribute, or None if it cannot be read or is empty."""
+    try:
+        with open(path, 'r', errors='replace') as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return value or None
+
+def read_vpd_serial(path):
+    """Unit serial number from a SCSI VPD page 0x80 (4 byte header, then ASCII)."""
+    try:
+        with open(path, 'rb') as f:
+            page = f.read()
+    except OSError:
+        return None
+    serial = page[4:4 + int.from_bytes(page[2:4], 'big')].decode('ascii', 'replace').strip(" \0")
+    return serial or None
+
+def resolve_block_device(maj_min, sys_root="/sys"):
+    """
+    Get device details from /sys/dev/block/<maj:min>.
+
+    Partitions report the model, serial and queue of their disk.
+
+    Args:
+        maj_min: Device number, e.g. "8:16"
+        sys_root: Where sysfs is mounted
+
+    Returns:
+        Dict with 'dev_name', 'model', 'serial' (None where sysfs does not
+        say), 'queue' (attribute -> value, see QUEUE_ATTRIBUTES) and
+        'disk_maj_min' (the whole disk's device number)
+    """
+    block = os.path.realpath(os.path.join(sys_root, "dev", "block", maj_min))
+    details = {'dev_name': os.path.basename(block), 'model': None, 'serial': None, 'queue': {},
+               'disk_maj_min': maj_min}
+    if not os.path.isdir(block):
+        details['dev_name'] = None
+        return details
+    disk = os.path.dirname(block) if os.path.exists(os.path.join(block, "partition")) else block
+
+    details['model'] = read_sysfs_attr(os.path.join(disk, "device", "model"))
+    details['serial'] = (read_sysfs_attr(os.path.join(disk, "device", "serial")) or
+                         read_sysfs_attr(os.path.join(disk, "serial")) or
+                         read_vpd_serial(os.path.join(disk, "device", "vpd_pg80")))
+    for attribute in QUEUE_ATTRIBUTES:
+        value = read_sysfs_attr(os.path.join(disk, "queue", attribute))
+        if value is not None and attribute == "scheduler":
+            # "mq-deadline [none]": the active one is in brackets
+            active = re.search(r"\[(.+?)\]", value)
+            value = active.group(1) if active else value
+        if value is not None:
+            details['queue'][attribute] = value
+    details['disk_maj_min'] = read_sysfs_attr(os.path.join(disk, "dev")) or maj_min
+    return details
+
+def lsblk_devices(log=print):
+    """
+    Model and serial of every disk by device number, from one lsblk call.
+
+    Returns:
+        Dict of maj:min -> lsblk entry (empty if lsblk fails)
     """
-    Get device details from a bcachefs device path using lsblk.
+    try:
+        cmd = ["lsblk", "-d", "-o", "MODEL,NAME,SERIAL,TYPE,UUID,MAJ:MIN", "--json"]
+        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        device_data = json.loads(result.stdout)
+    except Exception as e:
+        log(f"Failed to get device details: {e}")
+        return {}
+    return {device.get("maj:min"): device for device in device_data.get("blockdevices", [])}
+
+def resolve_devices(dev_paths, use_lsblk=True, log=print):
+    """
+    Resolve the block devices behind bcachefs devices in one pass.
+
+    Everything comes from sysfs; lsblk is run once, and only if some
+    device's model or serial is missing there.
+
+    Args:
+        dev_paths: Paths to devices in /sys/fs/bcachefs/*/dev-*
+        use_lsblk: Whether to fall back to lsblk
+        log: Function called with error messages
+
+    Returns:
+        Dict of maj:min -> details (see resolve_block_device)
+    """
+    devices = {}
+    for dev_path in dev_paths:
+        maj_min = read_sysfs_attr(os.path.join(dev_path, "block", "dev"))
+        if maj_min and maj_min not in devices:
+            devices[maj_min] = resolve_block_device(maj_min)
+
+    missing = [d for d in devices.values() if not (d['model'] and d['serial'] and d['dev_name'])]
+    if missing and use_lsblk:
+        disks = lsblk_devices(log)
+        for details in missing:
+            entry = disks.get(details['disk_maj_min'], {})
+            for key, lsblk_key in (('model', 'model'), ('serial', 'serial'), ('dev_name', 'name')):
+                details[key] = details[key] or (entry.get(lsblk_key) or "").strip() or None
+    return devices
+
+def get_device_details(dev_path, log=print, devices=None):
+    """
+    Get device details for a bcachefs device path.
     
     Args:
         dev_path: Path to the device in /sys/fs/bcachefs/*/dev-*
+        log: Function called with progress and error messages
+        devices: Output of resolve_devices covering this device (resolved
+            on the spot if not given)
         
     Returns:
-        Dict with device name, model, and serial
+        Dict with device name, model, serial and queue settings
     """
-    print(f"Examining device: {dev_path}")
+    log(f"Examining device: {dev_path}")
 
     # Get the major:minor device number from the path
     dev_file = f"{dev_path}/block/dev"
@@ -35,44 +153,512 @@ def get_device_details(dev_path):
         with open(dev_file, 'r') as f:
             maj_min = f.read().strip()
     except Exception as e:
-        print(f"Failed to read device number: {e}")
+        log(f"Failed to read device number: {e}")
         return {
             'dev_name': "Unknown dev_name",
             'model': "Unknown model",
-            'serial': "Unknown serial"
+            'serial': "Unknown serial",
+            'queue': {}
         }
 
-    # Run lsblk to get device information in JSON format
+    if devices is None:
+        devices = resolve_devices([dev_path], log=log)
+    details = devices.get(maj_min, {})
+    return {
+        'dev_name': details.get('dev_name') or "Unknown dev_name",
+        'model': details.get('model') or "Unknown model",
+        'serial': details.get('serial') or "Unknown serial",
+        'queue': dict(details.get('queue', {}))
+    }
+
+def format_queue(queue):
+    """The queue settings that matter for FUA, e.g. "write_cache=write back, fua=1, rotational=0"."""
+    return ", ".join(f"{key}={queue.get(key, '?')}" for key in ("write_cache", "fua", "rotational"))
+
+# PCI address of a device function, e.g. 0000:3d:00.0
+PCI_ADDRESS_RE = re.compile(r"^[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-9a-f]$")
+
+def get_controller(dev_path):
+    """
+    Identify the controller (HBA, AHCI or NVMe controller) a bcachefs
+    device is attached to.
+
+    Args:
+        dev_path: Path to the device in /sys/fs/bcachefs/*/dev-*
+
+    Returns:
+        PCI address of the nearest PCI device above the block device,
+        "virtual" for devices without one, or "unknown"
+    """
     try:
-        cmd = ["lsblk", "-d", "-o", "MODEL,NAME,SERIAL,TYPE,UUID,MAJ:MIN", "--json"]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        device_data = json.loads(result.stdout)
+        sys_path = os.path.realpath(os.path.join(dev_path, "block"))
+    except OSError:
+        return "unknown"
+    controller = None
+    for part in sys_path.split(os.sep):
+        if PCI_ADDRESS_RE.match(part):
+            controller = part
+    if controller:
+        return controller
+    return "virtual" if "/devices/virtual/" in sys_path else "unknown"
 
-        # Find the device with matching major:minor number
-        for device in device_data.get("blockdevices", []):
-            if device.get("maj:min") == maj_min:
-                return {
-                    'dev_name': device.get('name', "Unknown dev_name"),
-                    'model': device.get('model', "Unknown model"),
-                    'serial': device.get('serial', "Unknown serial")
-                }
-    except Exception as e:
-        print(f"Failed to get device details: {e}")
+def get_device_tier(dev_path):
+    """
+    Get the tier of a bcachefs device from its label (e.g. "ssd" for "ssd.ssd1").
 
-    # Default return if no match found
-    return {
-        'dev_name': "Unknown dev_name",
-        'model': "Unknown model",
-        'serial': "Unknown serial"
+    Args:
+        dev_path: Path to the device in /sys/fs/bcachefs/*/dev-*
+
+    Returns:
+        Tier name, or "unknown" if the device has no label
+    """
+    try:
+        with open(os.path.join(dev_path, "label"), "r") as f:
+            label = f.read().strip()
+    except OSError:
+        return "unknown"
+    return label.split(".")[0] if label else "unknown"
+
+def run_fua_test(dev_dir, devices=None):
+    """
+    Run the read FUA test of one device by reading its read_fua_test file.
+
+    Args:
+        dev_dir: Path to the device in /sys/fs/bcachefs/*/dev-*
+        devices: Output of resolve_devices (see get_device_details)
+
+    Returns:
+        Dict with device details, 'fua_test_result' (None if the test could
+        not run), 'fua_metrics' (see parse_fua_result), 'error',
+        'test_seconds' and the log messages collected
+    """
+    messages = []
+    result = get_device_details(dev_dir, log=messages.append, devices=devices)
+    result['fua_test_result'] = None
+    result['error'] = None
+    result['test_seconds'] = None
+
+    read_fua_test_file = os.path.join(dev_dir, 'read_fua_test')
+    if not os.path.isfile(read_fua_test_file):
+        result['error'] = "Read FUA Test file not found. Make sure you're using Kent Overstreet's development branch."
+    else:
+        # Reading the file makes the kernel run the test against the device
+        started = time.monotonic()
+        try:
+            with open(read_fua_test_file, 'r') as file:
+                result['fua_test_result'] = file.read().strip()
+        except Exception as e:
+            result['error'] = f"Error reading test file: {str(e)}"
+        result['test_seconds'] = time.monotonic() - started
+
+    result['fua_metrics'] = parse_fua_result(result['fua_test_result'])
+    result['messages'] = messages
+    return result
+
+def run_fua_tests(dev_dirs, jobs=8, per_controller=0, per_tier=0, devices=None, on_result=None):
+    """
+    Run the read FUA tests of several devices concurrently.
+
+    A device is started only while fewer than `per_controller` tests run on
+    its controller and fewer than `per_tier` on its tier (0 means no limit),
+    so devices on a busy HBA wait while others proceed. Among the devices
+    that may start, the first in device order goes first.
+
+    Args:
+        dev_dirs: Device paths (/sys/fs/bcachefs/*/dev-*) in report order
+        jobs: Maximum number of tests running at once
+        per_controller: Maximum tests at once per controller (0: no limit)
+        per_tier: Maximum tests at once per tier (0: no limit)
+        devices: Output of resolve_devices, shared by all tests
+        on_result: Called as on_result(dev_dir, result) from the worker
+            thread as soon as each test finishes, in completion order
+
+    Yields:
+        (dev_dir, result of run_fua_test with 'controller' and 'tier') in
+        the order of dev_dirs, each as soon as it and all before it are done
+    """
+    pending = [{'dev_dir': dev_dir, 'controller': get_controller(dev_dir),
+                'tier': get_device_tier(dev_dir), 'done': threading.Event(), 'result': None}
+               for dev_dir in dev_dirs]
+    queue = list(pending)
+    running = {'controller': {}, 'tier': {}}
+    limits = {'controller': per_controller, 'tier': per_tier}
+    condition = threading.Condition()
+
+    def eligible(item):
+        return all(not limits[kind] or running[kind].get(item[kind], 0) < limits[kind]
+                   for kind in limits)
+
+    def worker():
+        while True:
+            with condition:
+                while True:
+                    if not queue:
+                        return
+                    item = next((i for i in queue if eligible(i)), None)
+                    if item:
+                        break
+                    condition.wait()
+                queue.remove(item)
+                for kind in limits:
+                    running[kind][item[kind]] = running[kind].get(item[kind], 0) + 1
+            try:
+                item['result'] = run_fua_test(item['dev_dir'], devices)
+            except Exception as e:
+                item['result'] = {'dev_name': "Unknown dev_name", 'model': "Unknown model",
+                                  'serial': "Unknown serial", 'queue': {}, 'fua_test_result': None,
+                                  'fua_metrics': parse_fua_result(None), 'error': f"Test failed: {e}",
+                                  'test_seconds': None, 'messages': []}
+            item['result']['dev'] = os.path.basename(item['dev_dir'])
+            item['result']['controller'] = item['controller']
+            item['result']['tier'] = item['tier']
+            try:
+                if on_result:
+                    on_result(item['dev_dir'], item['result'])
+            except Exception as e:
+                # Keep testing the remaining devices; a dead worker would
+                # leave its queue untested and the caller waiting forever
+                item['result']['messages'].append(f"Failed to report result: {e}")
+            finally:
+                with condition:
+                    for kind in limits:
+                        running[kind][item[kind]] -= 1
+                    condition.notify_all()
+                item['done'].set()
+
+    threads = [threading.Thread(target=worker, daemon=True)
+               for _ in range(max(1, min(jobs, len(pending))))]
+    for thread in threads:
+        thread.start()
+    for item in pending:
+        item['done'].wait()
+        yield item['dev_dir'], item['result']
+
+# Units read_fua_test values may be printed in, scaled to microseconds
+# (latencies) or bytes per second (throughput)
+LATENCY_UNITS = {"ns": 1e-3, "us": 1.0, "µs": 1.0, "usec": 1.0, "ms": 1e3, "msec": 1e3, "s": 1e6, "sec": 1e6}
+THROUGHPUT_UNITS = {"b/s": 1, "kb/s": 1e3, "kib/s": 1024, "mb/s": 1e6, "mib/s": 1024 ** 2,
+                    "gb/s": 1e9, "gib/s": 1024 ** 3}
+
+# "[qualifier] number [unit]", e.g. "80 us", "mean 1.2 ms", "stddev: 5us", "310 MiB/s"
+FUA_VALUE_RE = re.compile(r"(?:\b([A-Za-z_]+)\s*[:=]?\s*)?(\d+(?:\.\d+)?)\s*([A-Za-zµ]+(?:/s)?)?")
+
+# "label value unit" without a colon, e.g. "nofua read 60 us"
+FUA_UNLABELED_RE = re.compile(r"^\s*([A-Za-z][A-Za-z _-]*?)\s+(\d.*)$")
+
+DEFAULT_HISTORY_FILE = "/var/lib/bcachefs-fua-test/history.json"
+
+# Runs kept per drive in the history file
+HISTORY_RUNS = 100
+
+def metric_name(text):
+    """Normalize a result label like "fua read" to "fua_read"."""
+    return re.sub(r"[^a-z0-9]+", "_", text.strip().lower()).strip("_")
+
+def parse_fua_result(content):
+    """
+    Extract the numeric fields of a read_fua_test result.
+
+    Every "label: value [unit]" (or "label value unit") line gives a metric
+    named after the label. Values preceded by a word are named after it as
+    well, so "fua read: mean 80 us stddev 5 us" gives fua_read_mean and
+    fua_read_stddev. Lines that do not parse are ignored.
+
+    Args:
+        content: Text of a read_fua_test file
+
+    Returns:
+        Dict with 'latency_us' and 'throughput_bps' (metric -> value in
+        microseconds or bytes/s) and 'other' (metric -> unitless value)
+    """
+    metrics = {'latency_us': {}, 'throughput_bps': {}, 'other': {}}
+    for line in (content or "").splitlines():
+        label, sep, rest = line.partition(":")
+        if not sep:
+            match = FUA_UNLABELED_RE.match(line)
+            if not match:
+                continue
+            label, rest = match.groups()
+        label = metric_name(label)
+        if not label:
+            continue
+        for index, (qualifier, number, unit) in enumerate(FUA_VALUE_RE.findall(rest)):
+            if index and not qualifier:
+                continue
+            name = f"{label}_{metric_name(qualifier)}" if qualifier else label
+            value = float(number)
+            unit = unit.lower()
+            if unit in LATENCY_UNITS:
+                metrics['latency_us'][name] = value * LATENCY_UNITS[unit]
+            elif unit in THROUGHPUT_UNITS:
+                metrics['throughput_bps'][name] = value * THROUGHPUT_UNITS[unit]
+            else:
+                metrics['other'][name] = value
+    return metrics
+
+def load_history(path):
+    """
+    Load the FUA result history.
+
+    Returns:
+        Dict of serial -> {'model': ..., 'runs': [...]}, empty if the file
+        does not exist yet
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_history(path, history):
+    """Write the history file atomically."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".history-")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(history, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def known_serial(device):
+    serial = device.get('serial')
+    return serial if serial and serial != "Unknown serial" else None
+
+def known_model(device):
+    model = device.get('model')
+    return model if model and model != "Unknown model" else None
+
+def record_history(history, results, when=None):
+    """Append this run's parsed metrics to each drive's history, keyed by serial."""
+    when = when or datetime.now().isoformat(timespec='seconds')
+    host = socket.gethostname()
+    for fs in results:
+        for device in fs['devices']:
+            serial = known_serial(device)
+            if not serial:
+                continue
+            entry = history.setdefault(serial, {'model': device.get('model'), 'runs': []})
+            entry['model'] = device.get('model') or entry.get('model')
+            entry['runs'].append({'time': when, 'host': host, 'fs_uuid': fs['uuid'],
+                                  'dev_name': device.get('dev_name'), 'queue': device.get('queue', {}),
+                                  'latency_us': device['fua_metrics']['latency_us'],
+                                  'throughput_bps': device['fua_metrics']['throughput_bps']})
+            del entry['runs'][:-HISTORY_RUNS]
+
+def check_regressions(results, history, threshold=0.5, min_delta_us=0.0):
+    """
+    Compare each device's FUA latencies with its own history and with
+    other drives of the same model.
+
+    Baseline is the median of the drive's earlier runs. Peers are the
+    other drives of the same model in this run, plus the latest run of
+    any other drive of that model in the history (at least two are
+    needed); drives of unknown model are only checked against their
+    baseline. A latency more than `threshold` above either median is
+    flagged, and so is one that far below it: a drive completing FUA I/O
+    much faster than it used to, or than its peers, is likely answering
+    from its cache.
+
+    Args:
+        results: Output of list_bcachefs_devices (with 'fua_metrics')
+        history: Output of load_history, before this run is recorded
+        threshold: Allowed relative increase, e.g. 0.5 for +50%
+        min_delta_us: Ignore changes smaller than this many microseconds
+
+    Returns:
+        List of findings; each is also added to its device's 'regressions'
+    """
+    devices = [d for fs in results for d in fs['devices']]
+    peers = {}
+    for device in devices:
+        if known_model(device):
+            peers.setdefault(known_model(device), {})[known_serial(device) or id(device)] = \
+                device['fua_metrics']['latency_us']
+    current = {known_serial(d) for d in devices}
+    for serial, entry in history.items():
+        if serial not in current and entry.get('runs') and known_model(entry):
+            peers.setdefault(known_model(entry), {}).setdefault(serial, entry['runs'][-1]['latency_us'])
+
+    findings = []
+    for device in devices:
+        serial = known_serial(device)
+        device['regressions'] = []
+        latencies = device['fua_metrics']['latency_us']
+        runs = history.get(serial, {}).get('runs', []) if serial else []
+        for metric, value in sorted(latencies.items()):
+            checks = []
+            earlier = [run['latency_us'][metric] for run in runs if metric in run.get('latency_us', {})]
+            if earlier:
+                checks.append(('baseline', median(earlier), len(earlier)))
+            others = [lat[metric] for key, lat in peers.get(known_model(device), {}).items()
+                      if key != (serial or id(device)) and metric in lat]
+            if len(others) >= 2:
+                checks.append(('peers', median(others), len(others)))
+            for kind, reference, samples in checks:
+                if abs(value - reference) < min_delta_us or reference <= 0:
+                    continue
+                if value > reference * (1 + threshold):
+                    problem = "slower"
+                elif value * (1 + threshold) < reference:
+                    problem = "faster"
+                else:
+                    continue
+                finding = {'serial': serial, 'model': device.get('model'), 'dev_name': device.get('dev_name'),
+                           'metric': metric, 'value_us': value, 'reference': kind,
+                           'reference_us': reference, 'samples': samples, 'problem': problem,
+                           'ratio': value / reference}
+                device['regressions'].append(finding)
+                findings.append(finding)
+    return findings
+
+def format_finding(finding):
+    """One line describing a check_regressions() finding."""
+    against = ("its baseline" if finding['reference'] == 'baseline'
+               else f"{finding['samples']} {finding['model']} peers")
+    line = (f"{finding['dev_name'] or 'unknown'} ({finding['model']}, serial {finding['serial'] or 'unknown'}): "
+            f"{finding['metric']} {finding['value_us']:.1f} us is {finding['ratio']:.2f}x "
+            f"the median {finding['reference_us']:.1f} us of {against}")
+    if finding['problem'] == "faster":
+        line += " - FUA may not be reaching the media"
+    return line
+
+# node-exporter's textfile collector directory on our hosts
+DEFAULT_TEXTFILE_DIR = "/var/lib/prometheus-node-exporter"
+
+class JsonLinesSink:
+    """
+    Appends one JSON object per line to a file ("-" for stdout), flushed
+    after every line so partial runs leave usable output. Safe to call
+    from the test worker threads.
+    """
+
+    def __init__(self, path):
+        self.owned = path != "-"
+        self.file = open(path, 'a') if self.owned else sys.stdout
+        self.lock = threading.Lock()
+        self.host = socket.gethostname()
+
+    def write(self, record):
+        line = json.dumps(record)
+        with self.lock:
+            if self.file is None:
+                return
+            try:
+                self.file.write(line + "\n")
+                self.file.flush()
+            except BrokenPipeError:
+                if self.owned:
+                    raise
+                # The reader went away (e.g. "--jsonl | head"): stop streaming
+                # and point stdout at /dev/null so the exit-time flush is quiet
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, self.file.fileno())
+                os.close(devnull)
+                self.file = None
+
+    def write_result(self, dev_dir, result):
+        """on_result callback for run_fua_tests: one "device" record per finished test."""
+        record = {'type': "device", 'time': datetime.now().isoformat(timespec='seconds'),
+                  'host': self.host, 'uuid': os.path.basename(os.path.dirname(dev_dir)),
+                  'dev': os.path.basename(dev_dir)}
+        record.update((key, value) for key, value in result.items() if key != 'messages')
+        self.write(record)
+
+    def write_finding(self, finding):
+        self.write(dict(finding, type="regression", time=datetime.now().isoformat(timespec='seconds'),
+                        host=self.host))
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_prometheus(results, findings=None):
+    """
+    Render FUA results (list_bcachefs_devices output, with 'regressions'
+    if check_regressions ran) in the Prometheus text exposition format,
+    labelled by drive serial and model so dashboards can group by model,
+    and by bcachefs device so drives sysfs could not identify stay distinct.
+    """
+    gauges = {
+        'bcachefs_fua_latency_seconds': "FUA test latency of a drive, by test.",
+        'bcachefs_fua_throughput_bytes_per_second': "FUA test throughput of a drive, by test.",
+        'bcachefs_fua_test_duration_seconds': "How long the drive's FUA test took.",
+        'bcachefs_fua_queue_write_cache': "1 if the drive's queue has a volatile write cache (write back).",
+        'bcachefs_fua_queue_fua': "1 if the block layer sends FUA to the drive.",
+        'bcachefs_fua_queue_rotational': "1 if the drive is rotational.",
+        'bcachefs_fua_regressions': "FUA latencies flagged against the drive's baseline or its peers.",
     }
+    samples = {name: [] for name in gauges}
+    for fs in results:
+        for device in fs['devices']:
+            labels = (f'dev="{_escape_label(device.get("dev"))}",'
+                      f'serial="{_escape_label(known_serial(device) or "unknown")}",'
+                      f'model="{_escape_label(device.get("model"))}",'
+                      f'device="{_escape_label(device.get("dev_name"))}",'
+                      f'uuid="{_escape_label(fs["uuid"])}",tier="{_escape_label(device.get("tier"))}"')
+            metrics = device['fua_metrics']
+            for test, value in sorted(metrics['latency_us'].items()):
+                samples['bcachefs_fua_latency_seconds'].append(
+                    f'{{{labels},test="{_escape_label(test)}"}} {value / 1e6:.9g}')
+            for test, value in sorted(metrics['throughput_bps'].items()):
+                samples['bcachefs_fua_throughput_bytes_per_second'].append(
+                    f'{{{labels},test="{_escape_label(test)}"}} {value:.9g}')
+            if device.get('test_seconds') is not None:
+                samples['bcachefs_fua_test_duration_seconds'].append(f"{{{labels}}} {device['test_seconds']:.6f}")
+            queue = device.get('queue', {})
+            if 'write_cache' in queue:
+                samples['bcachefs_fua_queue_write_cache'].append(
+                    f"{{{labels}}} {int(queue['write_cache'] == 'write back')}")
+            for attribute in ('fua', 'rotational'):
+                if queue.get(attribute, '').isdigit():
+                    samples[f'bcachefs_fua_queue_{attribute}'].append(f"{{{labels}}} {int(queue[attribute])}")
+            if findings is not None:
+                samples['bcachefs_fua_regressions'].append(f"{{{labels}}} {len(device.get('regressions', []))}")
 
-def list_bcachefs_devices(base_dir, output_path=None):
+    lines = []
+    for name, help_text in gauges.items():
+        if not samples[name]:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(name + sample for sample in samples[name])
+    lines.append("# HELP bcachefs_fua_last_run_timestamp_seconds When the FUA tests last ran.")
+    lines.append("# TYPE bcachefs_fua_last_run_timestamp_seconds gauge")
+    lines.append(f"bcachefs_fua_last_run_timestamp_seconds {time.time():.3f}")
+    return "\n".join(lines) + "\n"
+
+def write_textfile(page, directory):
+    """Atomically replace <directory>/bcachefs_fua.prom for node-exporter's textfile collector."""
+    fd, tmp_path = tempfile.mkstemp(prefix=".bcachefs_fua.", suffix=".prom.tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(page)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, os.path.join(directory, "bcachefs_fua.prom"))
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+def list_bcachefs_devices(base_dir, output_path=None, jobs=8, per_controller=0, per_tier=0,
+                          use_lsblk=True, on_result=None):
     """
     List all bcachefs devices and their read_fua_test results.
     
     Args:
         base_dir: Base directory for bcachefs (/sys/fs/bcachefs)
         output_path: Path to save the report (optional)
+        jobs: Maximum number of FUA tests running at once
+        per_controller: Maximum tests at once per controller (0: no limit)
+        per_tier: Maximum tests at once per tier (0: no limit)
+        use_lsblk: Fall back to lsblk for models and serials sysfs lacks
+        on_result: Called with each device's result as soon as its test
+            finishes (see run_fua_tests)
         
     Returns:
         List of results by filesystem
@@ -92,65 +678,76 @@ def list_bcachefs_devices(base_dir, output_path=None):
         report.write(f"Bcachefs Read FUA Test Results - {datetime.now()}\n")
         report.write("=" * 50 + "\n\n")
         
-        # Iterate over each bcachefs filesystem UUID directory
+        # Collect every device of every filesystem first so that all tests
+        # can run concurrently; the report is still written in device order
+        filesystems = []
         for uuid_dir in sorted(glob.glob(os.path.join(base_dir, '*'))):
             if os.path.isdir(uuid_dir) and not os.path.basename(uuid_dir) == "by-uuid":
-                uuid = os.path.basename(uuid_dir)
-                print(f"\nFilesystem UUID: {uuid}")
-                report.write(f"Filesystem UUID: {uuid}\n")
-                report.write("-" * 50 + "\n")
-                
-                fs_results = []
-                
-                # Iterate over each dev-* directory within the UUID directory
-                for dev_dir in sorted(glob.glob(os.path.join(uuid_dir, 'dev-*'))):
-                    if os.path.isdir(dev_dir):
-                        dev_num = os.path.basename(dev_dir).split('-')[1]
-                        print(f"\nTesting device {dev_num}:")
-                        report.write(f"\nDevice {dev_num}:\n")
-                        
-                        device_info = get_device_details(dev_dir)
-                        
-                        print(f"  Device: {device_info['dev_name'] or 'unknown'}")
-                        print(f"  Model: {device_info['model']}")
-                        print(f"  Serial: {device_info['serial']}")
-                        
-                        report.write(f"  Device: {device_info['dev_name'] or 'unknown'}\n")
-                        report.write(f"  Model: {device_info['model']}\n")
-                        report.write(f"  Serial: {device_info['serial']}\n")
-                        
-                        read_fua_test_file = os.path.join(dev_dir, 'read_fua_test')
-                        
-                        # Read and print the content of the read_fua_test file
-                        if os.path.isfile(read_fua_test_file):
-                            try:
-                                with open(read_fua_test_file, 'r') as file:
-                                    read_fua_test_content = file.read().strip()
-                                    print(f"\n  Read FUA Test Results:")
-                                    print(f"  {read_fua_test_content.replace('\n', '\n  ')}")
-                                    report.write("\n  Read FUA Test Results:\n")
-                                    report.write(f"  {read_fua_test_content.replace('\n', '\n  ')}\n")
-                                    
-                                    # Add to results
-                                    device_result = device_info.copy()
-                                    device_result['fua_test_result'] = read_fua_test_content
-                                    fs_results.append(device_result)
-                            except Exception as e:
-                                error_msg = f"Error reading test file: {str(e)}"
-                                print(f"  {error_msg}")
-                                report.write(f"  {error_msg}\n")
-                        else:
-                            error_msg = "Read FUA Test file not found. Make sure you're using Kent Overstreet's development branch."
-                            print(f"  {error_msg}")
-                            report.write(f"  {error_msg}\n")
-                        
-                        report.write("-" * 40 + "\n")
-                
-                # Add filesystem results
-                results.append({
-                    'uuid': uuid,
-                    'devices': fs_results
-                })
+                dev_dirs = [d for d in sorted(glob.glob(os.path.join(uuid_dir, 'dev-*'))) if os.path.isdir(d)]
+                filesystems.append((os.path.basename(uuid_dir), dev_dirs))
+
+        started = time.monotonic()
+        all_dev_dirs = [d for _, dev_dirs in filesystems for d in dev_dirs]
+        devices = resolve_devices(all_dev_dirs, use_lsblk)
+        tests = run_fua_tests(all_dev_dirs, jobs, per_controller, per_tier, devices, on_result)
+
+        for uuid, dev_dirs in filesystems:
+            print(f"\nFilesystem UUID: {uuid}")
+            report.write(f"Filesystem UUID: {uuid}\n")
+            report.write("-" * 50 + "\n")
+
+            fs_results = []
+
+            for dev_dir, result in (next(tests) for _ in dev_dirs):
+                dev_num = os.path.basename(dev_dir).split('-')[1]
+                print(f"\nTesting device {dev_num}:")
+                report.write(f"\nDevice {dev_num}:\n")
+                for message in result.pop('messages'):
+                    print(message)
+
+                print(f"  Device: {result['dev_name'] or 'unknown'}")
+                print(f"  Model: {result['model']}")
+                print(f"  Serial: {result['serial']}")
+                print(f"  Controller: {result['controller']}, tier: {result['tier']}")
+                print(f"  Queue: {format_queue(result['queue'])}")
+
+                report.write(f"  Device: {result['dev_name'] or 'unknown'}\n")
+                report.write(f"  Model: {result['model']}\n")
+                report.write(f"  Serial: {result['serial']}\n")
+                report.write(f"  Controller: {result['controller']}, tier: {result['tier']}\n")
+                report.write(f"  Queue: {format_queue(result['queue'])}\n")
+
+                if result['test_seconds'] is not None:
+                    print(f"  Test time: {result['test_seconds']:.3f} s")
+                    report.write(f"  Test time: {result['test_seconds']:.3f} s\n")
+
+                if result['fua_test_result'] is not None:
+                    indented = result['fua_test_result'].replace('\n', '\n  ')
+                    print("\n  Read FUA Test Results:")
+                    print(f"  {indented}")
+                    report.write("\n  Read FUA Test Results:\n")
+                    report.write(f"  {indented}\n")
+
+                    # Add to results
+                    device_result = dict(result)
+                    del device_result['error']
+                    fs_results.append(device_result)
+                else:
+                    print(f"  {result['error']}")
+                    report.write(f"  {result['error']}\n")
+
+                report.write("-" * 40 + "\n")
+
+            # Add filesystem results
+            results.append({
+                'uuid': uuid,
+                'devices': fs_results
+            })
+
+        elapsed = time.monotonic() - started
+        device_count = sum(len(dev_dirs) for _, dev_dirs in filesystems)
+        print(f"\nTested {device_count} devices in {elapsed:.3f} s")
+        report.write(f"\nTested {device_count} devices in {elapsed:.3f} s\n")
         
         # Summary
         report.write("\n\nSUMMARY:\n")
@@ -167,19 +764,22 @@ def list_bcachefs_devices(base_dir, output_path=None):
                     report.write("  No devices with read_fua_test support found.\n")
                 else:
                     for device in fs['devices']:
-                        report.write(f"  Device: {device['dev_name'] or 'unknown'}, Model: {device['model']}\n")
+                        report.write(f"  Device: {device['dev_name'] or 'unknown'}, Model: {device['model']}, "
+                                     f"test time: {device['test_seconds']:.3f} s\n")
+                        report.write(f"    queue: {format_queue(device['queue'])}\n")
                         
-                        # Try to extract performance values
-                        try:
-                            lines = device['fua_test_result'].strip().split('\n')
-                            for line in lines:
-                                if ':' in line:
-                                    report.write(f"    {line.strip()}\n")
-                        except:
-                            report.write(f"    Could not parse test results\n")
+                        metrics = device['fua_metrics']
+                        for name, value in sorted(metrics['latency_us'].items()):
+                            report.write(f"    {name}: {value:.1f} us\n")
+                        for name, value in sorted(metrics['throughput_bps'].items()):
+                            report.write(f"    {name}: {value / 1e6:.1f} MB/s\n")
+                        for name, value in sorted(metrics['other'].items()):
+                            report.write(f"    {name}: {value:g}\n")
+                        if not any(metrics.values()):
+                            report.write("    Could not parse test results\n")
     
     print(f"\nDetailed results saved to: {output_path}")
-    return results
+    return results, output_path
 
 def main():
     """Main entry point for the script."""
@@ -188,7 +788,31 @@ def main():
     parser.add_argument("--json", "-j", action="store_true", help="Output results in JSON format")
     parser.add_argument("--path", "-p", default="/sys/fs/bcachefs/", 
                         help="Base directory for bcachefs (default: /sys/fs/bcachefs/)")
+    parser.add_argument("--jobs", "-J", type=int, default=8,
+                        help="Maximum number of devices tested at once (default: 8)")
+    parser.add_argument("--per-controller", type=int, default=0,
+                        help="Maximum devices tested at once on the same controller/HBA (default: no limit)")
+    parser.add_argument("--per-tier", type=int, default=0,
+                        help="Maximum devices tested at once in the same tier (default: no limit)")
+    parser.add_argument("--no-lsblk", action="store_true",
+                        help="Only use sysfs for device models and serials")
+    parser.add_argument("--history", nargs="?", const=DEFAULT_HISTORY_FILE, metavar="FILE",
+                        help="Keep results per drive serial in FILE and flag FUA latency regressions "
+                             f"against each drive's baseline and same-model peers (default FILE: "
+                             f"{DEFAULT_HISTORY_FILE}); exits with status 2 if any are found")
+    parser.add_argument("--threshold", type=float, default=50,
+                        help="Flag latencies more than this many percent off the reference (default: 50)")
+    parser.add_argument("--min-delta", type=float, default=20,
+                        help="Ignore latency changes below this many microseconds (default: 20)")
+    parser.add_argument("--jsonl", nargs="?", const="-", metavar="FILE",
+                        help="Append one JSON line per device to FILE as each test finishes, and one per "
+                             "regression found (default: stdout, with the text report on stderr)")
+    parser.add_argument("--textfile", nargs="?", const=DEFAULT_TEXTFILE_DIR, metavar="DIR",
+                        help=f"Write bcachefs_fua.prom with FUA latency per drive serial for node-exporter's "
+                             f"textfile collector (default DIR: {DEFAULT_TEXTFILE_DIR})")
     args = parser.parse_args()
+    if args.json and args.jsonl == "-":
+        parser.error("--json cannot be combined with --jsonl on stdout; give --jsonl a FILE")
     
     # Define the base directory
     base_directory = args.path
@@ -197,8 +821,58 @@ def main():
         print(f"Error: bcachefs path {base_directory} does not exist!")
         sys.exit(1)
     
-    # Get results
-    results = list_bcachefs_devices(base_directory, args.output)
+    sink = None
+    if args.jsonl:
+        try:
+            sink = JsonLinesSink(args.jsonl)
+        except OSError as e:
+            print(f"Error opening {args.jsonl}: {e}")
+            sys.exit(1)
+
+    # With JSON lines on stdout, keep the human-readable output out of the stream
+    with redirect_stdout(sys.stderr) if args.jsonl == "-" else nullcontext():
+        try:
+            # Get results
+            results, report_path = list_bcachefs_devices(base_directory, args.output, max(args.jobs, 1),
+                                                         max(args.per_controller, 0), max(args.per_tier, 0),
+                                                         not args.no_lsblk,
+                                                         sink.write_result if sink else None)
+
+            findings = None
+            if args.history:
+                try:
+                    history = load_history(args.history)
+                    findings = check_regressions(results, history, max(args.threshold, 0) / 100,
+                                                 max(args.min_delta, 0))
+                    record_history(history, results)
+                    save_history(args.history, history)
+                except (OSError, ValueError) as e:
+                    print(f"Error updating history {args.history}: {e}")
+                    sys.exit(1)
+
+                lines = [format_finding(f) for f in findings] or ["No FUA latency regressions found."]
+                print("\nREGRESSIONS:")
+                for line in lines:
+                    print(f"  {line}")
+                with open(report_path, 'a') as report:
+                    report.write("\n\nREGRESSIONS:\n")
+                    report.write("=" * 50 + "\n")
+                    for line in lines:
+                        report.write(f"  {line}\n")
+                if sink:
+                    for finding in findings:
+                        sink.write_finding(finding)
+        finally:
+            if sink:
+                sink.close()
+
+        if args.textfile:
+            try:
+                write_textfile(format_prometheus(results, findings), args.textfile)
+            except OSError as e:
+                print(f"Error writing metrics to {args.textfile}: {e}")
+                sys.exit(1)
+            print(f"Prometheus metrics written to: {os.path.join(args.textfile, 'bcachefs_fua.prom')}")
     
     # Output JSON if requested
     if args.json:
@@ -207,5 +881,8 @@ def main():
         else:
             print(json.dumps({"error": "No bcachefs filesystems found"}))
 
+    if findings:
+        sys.exit(2)
+
 if __name__ == "__main__":
     main()
@@ -8,9 +8,27 @@ metrics grouped by device type (ssd, nvme, hdd).
 """
 
 import os
+import re
+import math
+import bisect
 import glob
+import operator
 import argparse
 import sys
+import time
+import json
+import threading
+import tempfile
+import struct
+import zlib
+import shlex
+import subprocess
+import resource
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import accumulate, repeat
 from pathlib import Path
 
 def format_bytes(num_bytes):
@@ -24,9 +42,9 @@ def format_bytes(num_bytes):
         num /= 1024
     return f"{num:.2f} PiB"
 
-def parse_io_done(file_path):
+def parse_io_done_text(content):
     """
-    Parse an io_done file.
+    Parse the contents of an io_done file.
     The file is expected to have two sections ("read:" and "write:")
     followed by lines with "key : value" pairs.
 
@@ -34,32 +52,147 @@ def parse_io_done(file_path):
     """
     results = {"read": {}, "write": {}}
     current_section = None
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        # Detect section headers.
+        if line.lower() in ("read:", "write:"):
+            current_section = line[:-1].lower()  # remove trailing colon
+            continue
+
+        if current_section is None:
+            continue
+
+        # Expect lines like "metric : value"
+        if ':' in line:
+            key_part, value_part = line.split(":", 1)
+            key = key_part.strip()
+            try:
+                value = int(value_part.strip())
+            except ValueError:
+                value = 0
+            results[current_section][key] = value
+    return results
+
+def parse_io_done(file_path):
+    """Parse an io_done file (see parse_io_done_text)."""
     try:
         with open(file_path, "r") as f:
+            return parse_io_done_text(f.read())
+    except Exception as e:
+        print(f"Error reading {file_path}: {e}")
+        return {"read": {}, "write": {}}
+
+def parse_label(content):
+    """Split a device label like "ssd.ssd1" into (group, device label)."""
+    parts = content.strip().split('.')
+    if len(parts) >= 2:
+        return parts[0].strip(), parts[1].strip()
+    return content.strip(), content.strip()
+
+# Write types that are filesystem metadata rather than file contents
+METADATA_TYPES = ("btree", "journal", "sb")
+
+def get_block_device_name(dev_path):
+    """Kernel name (as in /proc/diskstats) of the block device behind a dev-* directory."""
+    try:
+        return os.path.basename(os.readlink(os.path.join(dev_path, "block")))
+    except OSError:
+        return None
+
+def read_diskstats():
+    """Bytes written per block device since boot, from /proc/diskstats."""
+    written = {}
+    try:
+        with open("/proc/diskstats", "r") as f:
             for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                # Detect section headers.
-                if line.lower() in ("read:", "write:"):
-                    current_section = line[:-1].lower()  # remove trailing colon
-                    continue
+                fields = line.split()
+                # major minor name reads ... sectors_read ... writes ... sectors_written ...
+                if len(fields) >= 10:
+                    written[fields[2]] = int(fields[9]) * 512
+    except (OSError, ValueError) as e:
+        print(f"Error reading /proc/diskstats: {e}")
+    return written
 
-                if current_section is None:
-                    continue
+def read_data_replicas(base_dir):
+    """The filesystem's data_replicas option (1 if it cannot be read)."""
+    try:
+        with open(os.path.join(base_dir, "options", "data_replicas"), "r") as f:
+            return max(int(f.read().split()[0]), 1)
+    except (OSError, ValueError, IndexError):
+        return 1
 
-                # Expect lines like "metric : value"
-                if ':' in line:
-                    key_part, value_part = line.split(":", 1)
-                    key = key_part.strip()
-                    try:
-                        value = int(value_part.strip())
-                    except ValueError:
-                        value = 0
-                    results[current_section][key] = value
-    except Exception as e:
-        print(f"Error reading {file_path}: {e}")
-    return results
+def compute_amplification(write_totals, disk_written=None, replicas=1):
+    """
+    Write amplification and metadata share per group.
+
+    write_totals maps group -> {data type: bytes written} (from io_done);
+    disk_written optionally maps group -> bytes the block layer wrote for
+    the group's devices (from /proc/diskstats), or None if unknown.
+
+    io_done counts every replica of user data as "user" on its device, so
+    the logical user data is estimated as user bytes / data_replicas.
+    Write amplification is all bytes written to the devices over that:
+    replication, erasure coding parity, btree and journal writes and cache
+    promotion all add to it. The diskstats figure additionally includes
+    I/O bcachefs does not account in io_done (superblocks, flushes,
+    other users of the device).
+
+    Returns a dict with "groups" (group -> figures) and "total" (all groups).
+    """
+    def figures(totals, disk):
+        written = sum(totals.values())
+        logical = totals.get("user", 0) / replicas
+        metadata = sum(totals.get(t, 0) for t in METADATA_TYPES)
+        return {
+            "user_bytes": totals.get("user", 0),
+            "logical_user_bytes": logical,
+            "device_write_bytes": written,
+            "metadata_bytes": metadata,
+            "write_amplification": (written / logical) if logical else None,
+            "metadata_share": (metadata / written) if written else None,
+            "by_type_share": {t: v / written for t, v in sorted(totals.items()) if v and written},
+            "diskstats_write_bytes": disk,
+            "diskstats_amplification": (disk / logical) if disk is not None and logical else None,
+            "unaccounted_share": ((disk - written) / disk) if disk else None,
+        }
+
+    disk_written = disk_written or {}
+    groups = {}
+    combined = {}
+    combined_disk = 0
+    for group in sorted(write_totals.keys()):
+        totals = write_totals[group]
+        groups[group] = figures(totals, disk_written.get(group))
+        for metric, value in totals.items():
+            combined[metric] = combined.get(metric, 0) + value
+        if combined_disk is not None and disk_written.get(group) is not None:
+            combined_disk += disk_written[group]
+        else:
+            combined_disk = None
+    return {"groups": groups, "total": figures(combined, combined_disk)}
+
+def format_amplification(amplification):
+    """One line per group (and the total) of compute_amplification() output."""
+    def ratio(value):
+        return f"{value:.2f}x" if value is not None else "n/a"
+
+    def share(value):
+        return f"{value * 100:.1f}%" if value is not None else "n/a"
+
+    lines = []
+    rows = list(amplification["groups"].items()) + [("total", amplification["total"])]
+    for name, fig in rows:
+        line = (f"  {name:<10} WA {ratio(fig['write_amplification']):>8}  "
+                f"metadata {share(fig['metadata_share']):>6}  "
+                f"written {format_bytes(fig['device_write_bytes'])}")
+        if fig["diskstats_write_bytes"] is not None:
+            line += (f"  | diskstats {format_bytes(fig['diskstats_write_bytes'])}, "
+                     f"WA {ratio(fig['diskstats_amplification'])}, "
+                     f"unaccounted {share(fig['unaccounted_share'])}")
+        lines.append(line)
+    return "\n".join(lines)
 
 def find_bcachefs_instances():
     """Find all bcachefs instances in /sys/fs/bcachefs."""
@@ -88,74 +221,56 @@ def analyze_bcachefs_instance(base_dir):
     #    },
     #    ...
     # }
-    group_data = {}
-    overall = {"read": 0, "write": 0}
 
     # In your system, the devices appear as dev-* directories.
-    dev_paths = glob.glob(os.path.join(base_dir, "dev-*"))
-    if not dev_paths:
+    if not glob.glob(os.path.join(base_dir, "dev-*")):
         print(f"No dev-* directories found in {base_dir}!")
         return None
 
-    for dev_path in dev_paths:
-        # Each dev-* directory must have a label file.
-        label_file = os.path.join(dev_path, "label")
-        if not os.path.isfile(label_file):
-            continue
-        try:
-            with open(label_file, "r") as f:
-                content = f.read().strip()
-                # Expect a label like "ssd.ssd1"
-                parts = content.split('.')
-                if len(parts) >= 2:
-                    group = parts[0].strip()
-                    dev_label = parts[1].strip()
-                else:
-                    group = content.strip()
-                    dev_label = content.strip()
-        except Exception as e:
-            print(f"Error reading {label_file}: {e}")
-            continue
-
-        # Look for an io_done file in the same directory.
-        io_file = os.path.join(dev_path, "io_done")
-        if not os.path.isfile(io_file):
-            # If no io_done, skip this device.
-            continue
-
-        io_data = parse_io_done(io_file)
-
-        # Initialize the group if not already present.
-        if group not in group_data:
-            group_data[group] = {
-                "read": {"totals": {}, "devices": {}},
-                "write": {"totals": {}, "devices": {}}
-            }
-        # Register this device under the group for both read and write.
-        for section in ("read", "write"):
-            if dev_label not in group_data[group][section]["devices"]:
-                group_data[group][section]["devices"][dev_label] = {}
+    sampler = IoDoneSampler(base_dir)
+    try:
+        values = sampler.sample()["values"]
+    finally:
+        sampler.close()
 
-        # Process each section (read and write).
+    group_data = {}
+    for group, (start, end) in sampler.groups.items():
+        group_data[group] = {}
         for section in ("read", "write"):
-            for metric, value in io_data.get(section, {}).items():
-                # Update group totals.
-                group_totals = group_data[group][section]["totals"]
-                group_totals[metric] = group_totals.get(metric, 0) + value
-
-                # Update per-device breakdown.
-                dev_metrics = group_data[group][section]["devices"][dev_label]
-                dev_metrics[metric] = dev_metrics.get(metric, 0) + value
+            first, last = sampler.sections[section]
+            devices = {}
+            for row in range(start, end):
+                label = sampler.devices[row]["label"]
+                row_values = values[row * sampler.width + first:row * sampler.width + last]
+                metrics = sampler.metrics[section]
+                if label in devices:
+                    row_values = map(operator.add, row_values, devices[label].values())
+                devices[label] = dict(zip(metrics, row_values))
+            group_data[group][section] = {
+                "totals": dict(zip(sampler.metrics[section],
+                                   column_sums(values, sampler.width, start, end, first, last))),
+                "devices": devices
+            }
 
     # Compute overall totals for read and write across all groups.
-    for group in group_data:
-        for section in ("read", "write"):
-            section_total = sum(group_data[group][section]["totals"].values())
-            overall[section] += section_total
+    overall = {section: sum(column_sums(values, sampler.width, 0, len(sampler.devices), first, last))
+               for section, (first, last) in sampler.sections.items()}
+
+    # Cumulative amplification: io_done counts since mount, diskstats since boot
+    diskstats = read_diskstats()
+    disk_written = {}
+    for group, (start, end) in sampler.groups.items():
+        names = [device["block"] for device in sampler.devices[start:end]]
+        if all(name in diskstats for name in names):
+            disk_written[group] = sum(diskstats[name] for name in names)
+    amplification = compute_amplification(
+        {group: data["write"]["totals"] for group, data in group_data.items()}, disk_written,
+        sampler.replicas)
 
     return {
         "group_data": group_data,
         "overall": overall,
+        "amplification": amplification,
         "fs_uuid": os.path.basename(base_dir)
     }
 
@@ -192,14 +307,1407 @@ def print_metrics(analysis):
             print()  # blank line after section
         print()  # blank line after group
 
+    if analysis.get("amplification"):
+        print("Write amplification (io_done since mount, diskstats since boot):")
+        print(format_amplification(analysis["amplification"]))
+        print()
+
+# Values of "type : value" lines in io_done, in file order
+_IO_DONE_VALUE_RE = re.compile(rb":[ \t]*(\d+)")
+
+def column_sums(values, width, start, end, first=0, last=None):
+    """
+    Column totals of rows [start, end) of a row-major matrix with `width`
+    columns, for columns [first, last). Each column is one strided slice,
+    summed in C.
+    """
+    last = width if last is None else last
+    return [sum(values[start * width + col:end * width:width]) for col in range(first, last)]
+
+def matrix_delta(cur, prev):
+    """cur - prev element-wise, clamped at 0 (counters restart on remount)."""
+    return array("Q", map(max, map(operator.sub, cur, prev), repeat(0)))
+
+class IoDoneSampler:
+    """
+    Keeps the io_done files of one bcachefs instance open and re-reads them
+    with os.pread() at offset 0, which makes sysfs regenerate the content.
+    A sample then costs one read syscall per device, with no path lookup,
+    open or close.
+
+    A sample is a dense device x column matrix (array('Q'), row-major).
+    Rows are devices ordered by group, so every group is a contiguous block
+    of rows (self.groups). Columns are the read data types followed by the
+    write data types (self.sections). Totals, shares and deltas are then
+    slice and map operations over the whole array rather than per-metric
+    dict updates.
+    """
+
+    def __init__(self, base_dir):
+        self.fs_uuid = os.path.basename(base_dir)
+        self.replicas = read_data_replicas(base_dir)
+        self.devices = []
+        dev_paths = sorted(glob.glob(os.path.join(base_dir, "dev-*")))
+        # Members present when the sampler was built (see MetricsSnapshot.refresh)
+        self.dev_names = tuple(os.path.basename(p) for p in dev_paths)
+        for dev_path in dev_paths:
+            try:
+                with open(os.path.join(dev_path, "label"), "r") as f:
+                    group, dev_label = parse_label(f.read())
+                fd = os.open(os.path.join(dev_path, "io_done"), os.O_RDONLY | os.O_CLOEXEC)
+            except OSError:
+                continue
+            self.devices.append({"group": group, "label": dev_label, "dev": os.path.basename(dev_path),
+                                 "fd": fd, "block": get_block_device_name(dev_path)})
+        self.devices.sort(key=lambda d: (d["group"], d["label"], d["dev"]))
+
+        # Every device of a running kernel reports the same data types in the
+        # same order; take the layout from the first read
+        self.metrics = {"read": [], "write": []}
+        for device in self.devices:
+            content = self._read(device)
+            known = len(self.metrics["read"]) + len(self.metrics["write"])
+            if known and len(_IO_DONE_VALUE_RE.findall(content)) == known:
+                continue
+            io_data = parse_io_done_text(content.decode(errors="replace"))
+            for section in ("read", "write"):
+                for metric in io_data[section]:
+                    if metric not in self.metrics[section]:
+                        self.metrics[section].append(metric)
+        self._index_layout()
+
+    @classmethod
+    def from_layout(cls, layout):
+        """A sampler with no open files, for samples recorded elsewhere (see layout())."""
+        sampler = cls.__new__(cls)
+        sampler.fs_uuid = layout["fs_uuid"]
+        sampler.replicas = layout["replicas"]
+        sampler.devices = [{"group": d["group"], "label": d["label"], "dev": d.get("dev", ""),
+                            "fd": None, "block": d["block"]}
+                           for d in layout["devices"]]
+        sampler.dev_names = tuple(sorted(d["dev"] for d in sampler.devices))
+        sampler.metrics = {section: list(layout["metrics"][section]) for section in ("read", "write")}
+        sampler._index_layout()
+        return sampler
+
+    def layout(self):
+        """Everything needed to interpret this sampler's matrices, JSON-serializable."""
+        return {"fs_uuid": self.fs_uuid, "replicas": self.replicas,
+                "devices": [{"group": d["group"], "label": d["label"], "dev": d["dev"], "block": d["block"]}
+                            for d in self.devices],
+                "metrics": self.metrics}
+
+    def _index_layout(self):
+        self.groups = {}
+        for row, device in enumerate(self.devices):
+            start = self.groups.get(device["group"], (row, row))[0]
+            self.groups[device["group"]] = (start, row + 1)
+        n_read = len(self.metrics["read"])
+        self.width = n_read + len(self.metrics["write"])
+        self.sections = {"read": (0, n_read), "write": (n_read, self.width)}
+        self.columns = ([("read", m) for m in self.metrics["read"]] +
+                        [("write", m) for m in self.metrics["write"]])
+        self.column_index = {column: i for i, column in enumerate(self.columns)}
+        self.last = None
+
+    @staticmethod
+    def _read(device):
+        if device["fd"] is None:
+            return b""
+        try:
+            return os.pread(device["fd"], 65536, 0)
+        except OSError:
+            return b""
+
+    def parse_row(self, content):
+        """One matrix row from raw io_done bytes, or None if there are no values."""
+        numbers = _IO_DONE_VALUE_RE.findall(content)
+        if len(numbers) == self.width:
+            return map(int, numbers)
+        if not numbers:
+            return None
+        # Unexpected layout: place the values by name
+        row = [0] * self.width
+        io_data = parse_io_done_text(content.decode(errors="replace"))
+        for section in ("read", "write"):
+            for metric, value in io_data[section].items():
+                col = self.column_index.get((section, metric))
+                if col is not None:
+                    row[col] = value
+        return row
+
+    def sample(self, diskstats=False):
+        """
+        Return {"time": monotonic time, "wall": time.time(), "values":
+        device x column matrix}, and with diskstats also "diskstats": bytes
+        written per device row (None where the block device is unknown).
+        """
+        values = array("Q")
+        width = self.width
+        for row, device in enumerate(self.devices):
+            parsed = self.parse_row(self._read(device))
+            if parsed is None:
+                # A failed read must not look like the counters dropping to zero
+                parsed = self.last[row * width:(row + 1) * width] if self.last else [0] * width
+            values.extend(parsed)
+        self.last = values
+        sample = {"time": time.monotonic(), "wall": time.time(), "values": values}
+        if diskstats:
+            written = read_diskstats()
+            sample["diskstats"] = [written.get(d["block"]) for d in self.devices]
+        return sample
+
+    def close(self):
+        """Close the io_done files; the layout stays usable for results already sampled."""
+        for device in self.devices:
+            if device["fd"] is None:
+                continue
+            try:
+                os.close(device["fd"])
+            except OSError:
+                pass
+            device["fd"] = None
+
+# Rolling throughput windows (seconds) reported with --percentiles
+ROLLING_WINDOWS = (60, 300, 900)
+
+# Rates are kept as log-spaced bucket indices: bucket 0 is anything below
+# 4 KiB/s, then RATE_BUCKETS_PER_OCTAVE buckets per doubling up to ~256 GiB/s.
+# Reported values are bucket midpoints, within about 9% of the real rate.
+RATE_BUCKET_FLOOR = 4096
+RATE_BUCKETS_PER_OCTAVE = 4
+RATE_BUCKETS = 1 + 26 * RATE_BUCKETS_PER_OCTAVE
+
+# Bursts are judged against the median of this window
+BURST_WINDOW = 300
+BURST_MIN_SAMPLES = 5
+
+def rate_bucket(rate):
+    if rate < RATE_BUCKET_FLOOR:
+        return 0
+    return min(int(math.log2(rate / RATE_BUCKET_FLOOR) * RATE_BUCKETS_PER_OCTAVE) + 1, RATE_BUCKETS - 1)
+
+def bucket_rate(bucket):
+    if bucket == 0:
+        return 0.0
+    return RATE_BUCKET_FLOOR * 2 ** ((bucket - 0.5) / RATE_BUCKETS_PER_OCTAVE)
+
+class RollingStats:
+    """
+    Rolling-window rate distributions for a fixed set of cells (one per
+    device and data type, plus per-device read and write totals).
+
+    Memory is fixed up front. A circular buffer holds the bucket index of
+    every cell for the last max(windows) samples, one byte each. Every
+    window keeps a per-cell bucket histogram that is updated incrementally:
+    the new sample is counted in and the one falling out of the window is
+    counted out. Percentiles then come from one cumulative pass over a
+    cell's RATE_BUCKETS counts, however long the window is.
+    """
+
+    def __init__(self, cells, interval, windows=ROLLING_WINDOWS):
+        self.cells = cells
+        self.windows = {window: max(1, round(window / interval)) for window in windows}
+        self.capacity = max(self.windows.values())
+        self.ring = bytearray(self.capacity * cells)
+        self.counts = {window: array("I", bytes(4 * cells * RATE_BUCKETS)) for window in windows}
+        self.seen = 0
+
+    def add(self, rates):
+        buckets = bytes(map(rate_bucket, rates))
+        cells = self.cells
+        for window, length in self.windows.items():
+            counts = self.counts[window]
+            if self.seen < length:
+                for cell, bucket in enumerate(buckets):
+                    counts[cell * RATE_BUCKETS + bucket] += 1
+                continue
+            old_slot = (self.seen - length) % self.capacity
+            old = self.ring[old_slot * cells:(old_slot + 1) * cells]
+            if old == buckets:
+                continue
+            for cell, (new_bucket, old_bucket) in enumerate(zip(buckets, old)):
+                if new_bucket != old_bucket:
+                    counts[cell * RATE_BUCKETS + new_bucket] += 1
+                    counts[cell * RATE_BUCKETS + old_bucket] -= 1
+        slot = self.seen % self.capacity
+        self.ring[slot * cells:(slot + 1) * cells] = buckets
+        self.seen += 1
+
+    def samples(self, window):
+        return min(self.seen, self.windows[window])
+
+    def percentiles(self, cell, window, pcts=(50, 95, 99)):
+        """{"p50": ..., "p95": ..., "p99": ..., "max": ...} in bytes/s, or None before any sample."""
+        cumulative = list(accumulate(self.counts[window][cell * RATE_BUCKETS:(cell + 1) * RATE_BUCKETS]))
+        total = cumulative[-1]
+        if not total:
+            return None
+        result = {f"p{pct:g}": bucket_rate(bisect.bisect_left(cumulative, max(1, math.ceil(total * pct / 100))))
+                  for pct in pcts}
+        result["max"] = bucket_rate(bisect.bisect_left(cumulative, total))
+        return result
+
+def device_cells(sampler, rates):
+    """
+    Per-device cell rates for RollingStats: each device's columns followed
+    by its read and write totals (sampler.width + 2 cells per device).
+    """
+    width = sampler.width
+    cells = array("d")
+    for row in range(len(sampler.devices)):
+        row_rates = rates[row * width:(row + 1) * width]
+        cells.extend(row_rates)
+        for first, last in sampler.sections.values():
+            cells.append(sum(row_rates[first:last]))
+    return cells
+
+def detect_bursts(sampler, stats, cells, factor, min_rate):
+    """
+    Devices whose read or write total in the latest interval is above
+    `factor` times its rolling median (and above min_rate bytes/s). Call
+    before adding the interval to `stats` so a burst does not raise its
+    own baseline.
+    """
+    if stats.samples(BURST_WINDOW) < BURST_MIN_SAMPLES:
+        return []
+    stride = sampler.width + 2
+    bursts = []
+    for row, device in enumerate(sampler.devices):
+        for i, section in enumerate(("read", "write")):
+            cell = row * stride + sampler.width + i
+            rate = cells[cell]
+            if rate < min_rate:
+                continue
+            median = stats.percentiles(cell, BURST_WINDOW, (50,))["p50"]
+            if rate > factor * median:
+                bursts.append({"group": device["group"], "device": device["label"], "direction": section,
+                               "rate": rate, "median": median,
+                               "factor": (rate / median) if median else None})
+    return bursts
+
+def rolling_summary(sampler, stats):
+    """
+    group -> device -> direction -> {"total": {window: percentiles},
+    "types": {type: {window: percentiles}}}. Data types that were idle
+    over the longest window are left out.
+    """
+    stride = sampler.width + 2
+    longest = max(stats.windows)
+    summary = {}
+    for row, device in enumerate(sampler.devices):
+        dev_summary = summary.setdefault(device["group"], {}).setdefault(device["label"], {})
+        for i, (section, (first, last)) in enumerate(sampler.sections.items()):
+            base = row * stride
+            entry = {"total": {w: stats.percentiles(base + sampler.width + i, w) for w in stats.windows},
+                     "types": {}}
+            for col in range(first, last):
+                top = stats.percentiles(base + col, longest)
+                if top and top["max"] > 0:
+                    entry["types"][sampler.columns[col][1]] = {w: stats.percentiles(base + col, w)
+                                                               for w in stats.windows}
+            dev_summary[section] = entry
+    return summary
+
+def format_rolling(summary, bursts):
+    """Text block of rolling p50/p95/p99/max per device and direction, plus bursts."""
+    def cell(stats):
+        if not stats:
+            return "-"
+        return "/".join(f"{stats[k] / 1e6:.1f}" for k in ("p50", "p95", "p99", "max"))
+
+    windows = None
+    lines = []
+    for group in sorted(summary.keys()):
+        for dev_label in sorted(summary[group].keys()):
+            for section, entry in summary[group][dev_label].items():
+                windows = windows or list(entry["total"].keys())
+                name = f"{group}.{dev_label}" if section == "read" else ""
+                lines.append(f"  {name:<14} {section:<5} " +
+                             "  ".join(f"{cell(entry['total'][w]):>24}" for w in windows))
+    header = f"  {'Rolling MB/s':<14} {'':<5} " + "  ".join(
+        f"{(f'{w // 60}m' if w % 60 == 0 else f'{w}s') + ' p50/p95/p99/max':>24}" for w in (windows or []))
+    for burst in bursts:
+        factor = f"{burst['factor']:.1f}x median {burst['median'] / 1e6:.2f} MB/s" if burst["factor"] else "idle median"
+        lines.append(f"  BURST {burst['group']}.{burst['device']} {burst['direction']} "
+                     f"{burst['rate'] / 1e6:.2f} MB/s ({factor})")
+    return "\n".join([header] + lines)
+
+def rate_matrix(prev, cur):
+    """bytes/s per matrix cell between two samples."""
+    scale = 1 / max(cur["time"] - prev["time"], 1e-9)
+    return array("d", map(operator.mul, matrix_delta(cur["values"], prev["values"]), repeat(scale)))
+
+def compute_rates(sampler, rates):
+    """
+    Per-group and per-device bytes/s by direction and data type, from a
+    rate_matrix(). A counter that went backwards (remount) counts as zero.
+
+    Returns a dict: group -> {"read"/"write": {type: rate}, "devices": {label: {...}}}
+    """
+    width = sampler.width
+    groups = {}
+    for group, (start, end) in sampler.groups.items():
+        group_rates = {"devices": {}}
+        for section, (first, last) in sampler.sections.items():
+            group_rates[section] = dict(zip(sampler.metrics[section],
+                                            column_sums(rates, width, start, end, first, last)))
+        for row in range(start, end):
+            group_rates["devices"][sampler.devices[row]["label"]] = {
+                section: dict(zip(sampler.metrics[section], rates[row * width + first:row * width + last]))
+                for section, (first, last) in sampler.sections.items()
+            }
+        groups[group] = group_rates
+    return groups
+
+def window_amplification(sampler, prev, cur):
+    """compute_amplification() over the writes between two samples taken with diskstats."""
+    delta = matrix_delta(cur["values"], prev["values"])
+    first, last = sampler.sections["write"]
+    write_totals, disk_written = {}, {}
+    for group, (start, end) in sampler.groups.items():
+        write_totals[group] = dict(zip(sampler.metrics["write"],
+                                       column_sums(delta, sampler.width, start, end, first, last)))
+        before = prev.get("diskstats", [None] * end)[start:end]
+        after = cur.get("diskstats", [None] * end)[start:end]
+        if None not in before and None not in after:
+            disk_written[group] = sum(max(a - b, 0) for a, b in zip(after, before))
+    return compute_amplification(write_totals, disk_written, sampler.replicas)
+
+def format_rate_breakdown(rates):
+    """Total MB/s plus the data types that saw any I/O, busiest first."""
+    total = sum(rates.values())
+    busy = sorted(((m, r) for m, r in rates.items() if r > 0), key=lambda x: -x[1])
+    breakdown = ", ".join(f"{m} {r / 1e6:.2f}" for m, r in busy)
+    return f"{total / 1e6:9.2f} MB/s" + (f" [{breakdown}]" if breakdown else "")
+
+def print_rates(fs_uuid, groups, interval, amplification=None, when=None):
+    """Print an iostat-like block of per-group and per-device rates (as of `when`, default now)."""
+    stamp = datetime.fromtimestamp(when) if when is not None else datetime.now()
+    print(f"=== {stamp.strftime('%H:%M:%S')} {fs_uuid} (interval {interval:g}s) ===")
+    if amplification:
+        print(format_amplification(amplification))
+    for group in sorted(groups.keys()):
+        group_rates = groups[group]
+        print(f"{group:<12} read {format_rate_breakdown(group_rates['read'])}")
+        print(f"{'':<12} write{format_rate_breakdown(group_rates['write'])}")
+        for dev_label in sorted(group_rates["devices"].keys()):
+            dev_rates = group_rates["devices"][dev_label]
+            print(f"  {dev_label:<10} read {format_rate_breakdown(dev_rates['read'])}")
+            print(f"  {'':<10} write{format_rate_breakdown(dev_rates['write'])}")
+    print()
+
+# read_bytes/write_bytes lines of /proc/<pid>/io
+_PROC_IO_RE = re.compile(rb"^(read_bytes|write_bytes): (\d+)", re.M)
+
+# File descriptors kept free for everything but cached /proc/<pid>/io handles
+PROC_FD_RESERVE = 256
+
+def _unescape_mountinfo(field):
+    """Undo the \\ooo octal escapes (space, tab, newline, backslash) of a mountinfo path."""
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+def parse_mountinfo(content, fs_devices):
+    """
+    Mount point -> fs uuid (None for anything that is not one of our
+    bcachefs instances) from a mountinfo file. fs_devices maps fs uuid ->
+    kernel names of its block devices; a bcachefs mount belongs to the
+    instance that owns one of the devices in its source ("/dev/sda:/dev/sdb")
+    or whose uuid it names ("UUID=..."). Later mounts on the same path hide
+    earlier ones, as in the kernel.
+    """
+    owners = {name: fs_uuid for fs_uuid, names in fs_devices.items() for name in names}
+    table = {}
+    for line in content.splitlines():
+        fields, _, tail = line.partition(" - ")
+        fields, tail = fields.split(), tail.split()
+        if len(fields) < 5 or len(tail) < 2:
+            continue
+        fs_uuid = None
+        if tail[0] == "bcachefs":
+            source = tail[1]
+            if source.startswith("UUID=") and source[5:] in fs_devices:
+                fs_uuid = source[5:]
+            for device in source.split(":"):
+                name = os.path.basename(os.path.realpath(device)) if device.startswith("/dev/") else device
+                if fs_uuid is None and name in owners:
+                    fs_uuid = owners[name]
+        table[_unescape_mountinfo(fields[4])] = fs_uuid
+    return table
+
+def mount_owner(table, path):
+    """fs uuid (or None) of the innermost mount containing path."""
+    while True:
+        if path in table:
+            return table[path]
+        if path == "/" or not path.startswith("/"):
+            return None
+        path = os.path.dirname(path)
+
+class ProcessIoSampler:
+    """
+    Per-process I/O (/proc/<pid>/io read_bytes and write_bytes) of the
+    processes that have files open on our bcachefs mounts.
+
+    A sampling interval stays cheap with thousands of processes:
+    - /proc/<pid>/io stays open and is re-read with pread(), as io_done
+      is, for as many processes as the fd limit allows
+    - only processes whose counters moved are matched to a mount, by
+      their cwd and open fds, and the answer is cached per process for
+      `recheck` seconds
+    - mount tables are parsed once per mount namespace (containers see
+      their own paths), also for `recheck` seconds
+
+    read_bytes counts reads that reached the block layer; write_bytes
+    counts data dirtied in the page cache, so a writer is credited when it
+    writes rather than at writeback. The kernel adds the I/O of reaped
+    children to their parent, so short-lived workers (a shell loop running
+    dd) show up under their parent.
+    """
+
+    def __init__(self, fs_devices, recheck=30):
+        self.fs_devices = fs_devices
+        self.recheck = recheck
+        self.procs = {}
+        self.skipped = set()  # pids whose /proc/<pid>/io we may not read
+        self.namespaces = {}
+        self.time = None
+        self.cached_fds = 0
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        self.max_cached_fds = max(soft - PROC_FD_RESERVE, 0) if soft != resource.RLIM_INFINITY else 65536
+
+    def _read_counters(self, pid, state):
+        try:
+            if state["fd"] is not None:
+                content = os.pread(state["fd"], 4096, 0)
+            else:
+                with open(f"/proc/{pid}/io", "rb") as f:
+                    content = f.read()
+        except OSError:
+            return None
+        counters = dict(_PROC_IO_RE.findall(content))
+        return int(counters.get(b"read_bytes", 0)), int(counters.get(b"write_bytes", 0))
+
+    def _forget(self, pid):
+        state = self.procs.pop(pid)
+        if state["fd"] is not None:
+            try:
+                os.close(state["fd"])
+            except OSError:
+                pass
+            self.cached_fds -= 1
+
+    def _track(self, pid):
+        fd = None
+        if self.cached_fds < self.max_cached_fds:
+            try:
+                fd = os.open(f"/proc/{pid}/io", os.O_RDONLY | os.O_CLOEXEC)
+                self.cached_fds += 1
+            except OSError:
+                # Gone, or not ours to read (needs ptrace access); don't
+                # retry every interval while the pid lives
+                self.skipped.add(pid)
+                return None
+        state = {"fd": fd, "read": 0, "write": 0, "fs": None, "checked": None,
+                 "comm": None, "cgroup": None}
+        self.procs[pid] = state
+        return state
+
+    def _mount_table(self, pid, now):
+        try:
+            namespace = os.readlink(f"/proc/{pid}/ns/mnt")
+        except OSError:
+            namespace = None
+        cached = self.namespaces.get(namespace)
+        if cached and now - cached[0] < self.recheck:
+            return cached[1]
+        try:
+            with open(f"/proc/{pid}/mountinfo", "r") as f:
+                table = parse_mountinfo(f.read(), self.fs_devices)
+        except OSError:
+            return {}
+        self.namespaces[namespace] = (now, table)
+        return table
+
+    def _match(self, pid, state, now):
+        """Set the instances a process has files on (cwd and open fds)."""
+        table = self._mount_table(pid, now)
+        paths = []
+        try:
+            paths.append(os.readlink(f"/proc/{pid}/cwd"))
+            fd_dir = f"/proc/{pid}/fd"
+            for fd in os.listdir(fd_dir):
+                try:
+                    paths.append(os.readlink(f"{fd_dir}/{fd}"))
+                except OSError:
+                    pass
+        except OSError:
+            pass
+        owners = {mount_owner(table, path) for path in paths if path.startswith("/")}
+        owners.discard(None)
+        state["fs"] = tuple(sorted(owners))
+        state["checked"] = now
+        if state["comm"] is None:
+            try:
+                with open(f"/proc/{pid}/comm", "r") as f:
+                    state["comm"] = f.read().strip()
+                with open(f"/proc/{pid}/cgroup", "r") as f:
+                    # cgroup v2 is "0::/path"; with v1 hierarchies take the first
+                    lines = f.read().splitlines()
+                    v2 = [line for line in lines if line.startswith("0::")]
+                    state["cgroup"] = (v2 or lines or ["::?"])[0].split(":", 2)[2]
+            except (OSError, IndexError):
+                pass
+
+    def sample(self):
+        """
+        {"time", "elapsed", "processes": [{"pid", "comm", "cgroup", "fs",
+        "read", "write"}]} with bytes/s since the previous call, for the
+        processes with I/O that have files on one of our instances. The
+        first call only takes the baseline ("elapsed" None).
+        """
+        now = time.monotonic()
+        try:
+            pids = {int(name) for name in os.listdir("/proc") if name.isdigit()}
+        except OSError:
+            pids = set()
+        for pid in [pid for pid in self.procs if pid not in pids]:
+            self._forget(pid)
+        self.skipped &= pids
+
+        first = self.time is None
+        elapsed = None if first else max(now - self.time, 1e-9)
+        processes = []
+        for pid in pids:
+            state = self.procs.get(pid)
+            new = state is None
+            if new:
+                if pid in self.skipped:
+                    continue
+                state = self._track(pid)
+                if state is None:
+                    continue
+            counters = self._read_counters(pid, state)
+            if counters is None:
+                self._forget(pid)
+                continue
+            read, write = counters
+            if read < state["read"] or write < state["write"]:
+                # The pid was reused
+                state.update(read=0, write=0, fs=None, comm=None, cgroup=None)
+            delta_read, delta_write = read - state["read"], write - state["write"]
+            state["read"], state["write"] = read, write
+            # A process that appeared since the last sample did all its I/O in
+            # this interval; at the first sample, everything is history
+            if first or not (delta_read or delta_write):
+                continue
+            if state["fs"] is None or now - state["checked"] >= self.recheck:
+                self._match(pid, state, now)
+            if state["fs"]:
+                processes.append({"pid": pid, "comm": state["comm"], "cgroup": state["cgroup"],
+                                  "fs": state["fs"], "read": delta_read / elapsed,
+                                  "write": delta_write / elapsed})
+        self.time = now
+        return {"time": now, "elapsed": elapsed, "processes": processes}
+
+    def close(self):
+        for pid in list(self.procs):
+            self._forget(pid)
+
+def attribute_processes(groups, processes, fs_uuid, by="process", top=10):
+    """
+    Split each group's read and write rate between the processes (or
+    cgroups) with files on fs_uuid, in proportion to their own read and
+    write rates. Only processes are seen, not which device their I/O went
+    to, so this is each workload's estimated share of every tier.
+
+    Returns {"read", "write": matched process bytes/s, "by": by,
+    "top": [{"name", "pids", "read", "write", "tiers": {group: {"read", "write"}}}]}.
+    """
+    entries = {}
+    for proc in processes:
+        if fs_uuid not in proc["fs"]:
+            continue
+        if by == "cgroup":
+            key = proc["cgroup"] or "?"
+        else:
+            key = f"{proc['pid']} {proc['comm'] or '?'}"
+        entry = entries.setdefault(key, {"name": key, "pids": [], "read": 0.0, "write": 0.0})
+        entry["pids"].append(proc["pid"])
+        entry["read"] += proc["read"]
+        entry["write"] += proc["write"]
+    total_read = sum(e["read"] for e in entries.values())
+    total_write = sum(e["write"] for e in entries.values())
+    ranked = sorted(entries.values(), key=lambda e: -(e["read"] + e["write"]))[:top]
+    for entry in ranked:
+        entry["tiers"] = {
+            group: {"read": sum(rates["read"].values()) * entry["read"] / total_read if total_read else 0.0,
+                    "write": sum(rates["write"].values()) * entry["write"] / total_write if total_write else 0.0}
+            for group, rates in sorted(groups.items())
+        }
+    return {"read": total_read, "write": total_write, "by": by, "top": ranked}
+
+def format_attribution(attribution):
+    """Text block of attribute_processes() output."""
+    lines = [f"  Top {'cgroups' if attribution['by'] == 'cgroup' else 'processes'} "
+             f"(matched {attribution['read'] / 1e6:.2f} MB/s read, {attribution['write'] / 1e6:.2f} MB/s write; "
+             f"tier estimates read/write MB/s):"]
+    for entry in attribution["top"]:
+        tiers = ", ".join(f"{group} {v['read'] / 1e6:.1f}/{v['write'] / 1e6:.1f}"
+                          for group, v in entry["tiers"].items() if v["read"] or v["write"])
+        lines.append(f"    {entry['name'][:32]:<32} read {entry['read'] / 1e6:9.2f}  "
+                     f"write {entry['write'] / 1e6:9.2f}" + (f"  ~ {tiers}" if tiers else ""))
+    if not attribution["top"]:
+        lines.append("    (no process I/O on this filesystem)")
+    return "\n".join(lines)
+
+def report_interval(sampler, stats, before, after, interval, as_json=False,
+                    burst_factor=4.0, burst_min=1e6, process_io=None, by="process", top=10):
+    """
+    Print the rates between two samples of one sampler (taken about
+    `interval` seconds apart), as text or one JSON line. With a
+    RollingStats, also add the interval to it and print the rolling
+    percentiles and bursts. With a ProcessIoSampler.sample() for the same
+    interval, also the busiest processes and their estimated tier shares.
+    """
+    rates = rate_matrix(before, after)
+    groups = compute_rates(sampler, rates)
+    amplification = window_amplification(sampler, before, after)
+    summary = bursts = None
+    if stats is not None:
+        cells = device_cells(sampler, rates)
+        bursts = detect_bursts(sampler, stats, cells, burst_factor, burst_min)
+        stats.add(cells)
+        summary = rolling_summary(sampler, stats)
+    attribution = None
+    if process_io is not None:
+        attribution = attribute_processes(groups, process_io["processes"], sampler.fs_uuid, by, top)
+    if as_json:
+        record = {"fs_uuid": sampler.fs_uuid, "time": after["wall"],
+                  "interval": after["time"] - before["time"], "groups": groups,
+                  "amplification": amplification}
+        if stats is not None:
+            record["rolling"] = summary
+            record["bursts"] = bursts
+        if attribution is not None:
+            record["processes"] = attribution
+        print(json.dumps(record))
+    else:
+        print_rates(sampler.fs_uuid, groups, interval, amplification, after["wall"])
+        if stats is not None:
+            print(format_rolling(summary, bursts))
+            print()
+        if attribution is not None:
+            print(format_attribution(attribution))
+            print()
+
+def sample_instances(base_dirs, interval, count=None, as_json=False,
+                     percentiles=False, burst_factor=4.0, burst_min=1e6, writer=None,
+                     processes=None, top=10):
+    """
+    Print rates for every instance each `interval` seconds, `count` times
+    (forever if None). With as_json, one JSON object per line and tick.
+    With percentiles, also rolling p50/p95/p99/max over ROLLING_WINDOWS and
+    bursts above burst_factor x the rolling median. With writer (a
+    TraceWriter, closed when sampling ends), also record every sample;
+    recording stops if the trace can no longer be written. With
+    processes ("process" or "cgroup"), also the `top` processes or cgroups
+    doing I/O on each instance (see ProcessIoSampler).
+    """
+    samplers = [IoDoneSampler(base_dir) for base_dir in base_dirs]
+    process_sampler = None
+    if processes:
+        process_sampler = ProcessIoSampler({s.fs_uuid: {d["block"] for d in s.devices if d["block"]}
+                                            for s in samplers})
+    rolling = [RollingStats(len(s.devices) * (s.width + 2), interval) if percentiles else None
+               for s in samplers]
+
+    def record(samples):
+        nonlocal writer
+        try:
+            for trace_id, sample in zip(trace_ids, samples):
+                writer.write(trace_id, sample)
+            writer.flush()
+        except OSError as e:
+            print(f"Error recording to {writer.path}: {e}; recording stopped")
+            try:
+                writer.close()
+            except OSError:
+                pass
+            writer = None
+
+    try:
+        if writer:
+            trace_ids = [writer.add_instance(sampler, interval) for sampler in samplers]
+        prev = [sampler.sample(diskstats=True) for sampler in samplers]
+        process_io = process_sampler.sample() if process_sampler else None
+        if writer:
+            record(prev)
+        next_tick = time.monotonic()
+        ticks = 0
+        while count is None or ticks < count:
+            # Sleep to a fixed schedule so the print time does not drift
+            next_tick += interval
+            time.sleep(max(next_tick - time.monotonic(), 0))
+            cur = [sampler.sample(diskstats=True) for sampler in samplers]
+            if process_sampler:
+                process_io = process_sampler.sample()
+            if writer:
+                record(cur)
+            for sampler, stats, before, after in zip(samplers, rolling, prev, cur):
+                report_interval(sampler, stats, before, after, interval, as_json, burst_factor, burst_min,
+                                process_io, processes, top)
+            sys.stdout.flush()
+            prev = cur
+            ticks += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if writer:
+            writer.close()
+        if process_sampler:
+            process_sampler.close()
+        for sampler in samplers:
+            sampler.close()
+
+# Trace files (--record/--replay) are a magic followed by frames of
+# <kind, payload length> + payload, appended as the samples are taken:
+#
+#   b"L"  layout of one instance: JSON of IoDoneSampler.layout() plus the
+#         trace id its samples use and the recording interval
+#   b"S"  one sample: <trace id, wall time, monotonic time>, then the
+#         counter matrix followed by the diskstats column (-1 if unknown)
+#         as int64 deltas against the instance's previous sample,
+#         byte-shuffled and zlib-compressed
+#
+# Idle counters make most deltas zero, so a sample of a quiet 30-device
+# filesystem is a few hundred bytes. A layout frame restarts the deltas
+# of its trace id, so a trace can be appended to by later recordings.
+TRACE_MAGIC = b"BCIOTRC1"
+_TRACE_FRAME = struct.Struct("<cI")
+_TRACE_SAMPLE = struct.Struct("<Hdd")
+
+def _shuffle_int64(values):
+    """Little-endian bytes of an array('q'), all first bytes first, then all second bytes, ..."""
+    if sys.byteorder == "big":
+        values = array("q", values)
+        values.byteswap()
+    raw = values.tobytes()
+    return b"".join(raw[i::8] for i in range(8))
+
+def _unshuffle_int64(shuffled):
+    raw = bytearray(len(shuffled))
+    n = len(shuffled) // 8
+    for i in range(8):
+        raw[i::8] = shuffled[i * n:(i + 1) * n]
+    values = array("q", bytes(raw))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+class TraceWriter:
+    """
+    Appends samples to a trace file. An existing trace is appended to; a
+    partial frame at its end (from a recorder that was killed mid-write)
+    is cut off first.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a+b")
+        self.file.seek(0)
+        if self.file.read(len(TRACE_MAGIC)) == TRACE_MAGIC:
+            end = _trace_end(self.file)
+            self.file.truncate(end)
+        elif self.file.seek(0, os.SEEK_END):
+            self.file.close()
+            raise ValueError(f"{path} exists and is not a bcachefs-io-metrics trace")
+        else:
+            self.file.write(TRACE_MAGIC)
+        self.previous = {}
+
+    def _frame(self, kind, payload):
+        self.file.write(_TRACE_FRAME.pack(kind, len(payload)) + payload)
+
+    def add_instance(self, sampler, interval):
+        """Write the layout of a sampler; returns the trace id for its samples."""
+        trace_id = len(self.previous)
+        layout = dict(sampler.layout(), id=trace_id, interval=interval)
+        self._frame(b"L", json.dumps(layout).encode())
+        self.previous[trace_id] = None
+        return trace_id
+
+    def write(self, trace_id, sample):
+        diskstats = sample.get("diskstats") or [None] * len(sample["values"])
+        current = array("q", sample["values"])
+        current.extend(-1 if value is None else value for value in diskstats)
+        previous = self.previous[trace_id]
+        delta = array("q", map(operator.sub, current, previous)) if previous else current
+        self.previous[trace_id] = current
+        header = _TRACE_SAMPLE.pack(trace_id, sample["wall"], sample["time"])
+        self._frame(b"S", header + zlib.compress(_shuffle_int64(delta), 6))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def _trace_end(f):
+    """Offset just past the last complete frame of a trace open at its first frame."""
+    end = f.tell()
+    while True:
+        header = f.read(_TRACE_FRAME.size)
+        if len(header) < _TRACE_FRAME.size:
+            return end
+        _, length = _TRACE_FRAME.unpack(header)
+        if f.seek(length, os.SEEK_CUR) > os.fstat(f.fileno()).st_size:
+            return end
+        end = f.tell()
+
+def read_trace(path):
+    """
+    Yield ("layout", sampler, interval) for every layout frame and
+    ("sample", sampler, sample) for every sample of a trace, in recording
+    order. Samples carry "time", "wall", "values" and "diskstats" like
+    IoDoneSampler.sample(diskstats=True). A partial last frame is ignored.
+    """
+    samplers, previous = {}, {}
+    with open(path, "rb") as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a bcachefs-io-metrics trace")
+        while True:
+            header = f.read(_TRACE_FRAME.size)
+            if len(header) < _TRACE_FRAME.size:
+                return
+            kind, length = _TRACE_FRAME.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            if kind == b"L":
+                layout = json.loads(payload)
+                sampler = IoDoneSampler.from_layout(layout)
+                samplers[layout["id"]] = sampler
+                previous[layout["id"]] = None
+                yield "layout", sampler, layout["interval"]
+            elif kind == b"S":
+                trace_id, wall, monotonic = _TRACE_SAMPLE.unpack_from(payload)
+                sampler = samplers[trace_id]
+                current = _unshuffle_int64(zlib.decompress(payload[_TRACE_SAMPLE.size:]))
+                if previous[trace_id] is not None:
+                    current = array("q", map(operator.add, previous[trace_id], current))
+                previous[trace_id] = current
+                cells = len(sampler.devices) * sampler.width
+                diskstats = current[cells:]
+                yield "sample", sampler, {
+                    "time": monotonic, "wall": wall,
+                    "values": array("Q", current[:cells]),
+                    "diskstats": [None if value < 0 else value for value in diskstats],
+                }
+
+def replay_trace(path, interval=None, speed=0, as_json=False,
+                 percentiles=False, burst_factor=4.0, burst_min=1e6):
+    """
+    Feed a recorded trace through the same reporting as live sampling.
+    With interval, report windows of at least that many seconds (a
+    multiple of the recording interval) instead of every recorded
+    interval. speed paces the output at that multiple of real time; 0
+    replays as fast as possible.
+    """
+    state = {}
+    paced = None
+    try:
+        for kind, sampler, item in read_trace(path):
+            if kind == "layout":
+                window = interval or item
+                stats = (RollingStats(len(sampler.devices) * (sampler.width + 2), window)
+                         if percentiles else None)
+                # Recorded ticks jitter, so a window is complete within half a tick
+                state[sampler.fs_uuid] = [sampler, stats, None, window, window - item / 2]
+                continue
+            entry = state[sampler.fs_uuid]
+            before = entry[2]
+            if before is None:
+                entry[2] = item
+                continue
+            if item["time"] - before["time"] < entry[4]:
+                continue
+            if speed:
+                # (trace wall time, real time) of the first report
+                paced = paced or (before["wall"], time.monotonic())
+                time.sleep(max(paced[1] + (item["wall"] - paced[0]) / speed - time.monotonic(), 0))
+            report_interval(entry[0], entry[1], before, item, entry[3], as_json, burst_factor, burst_min)
+            entry[2] = item
+        sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+# node-exporter's textfile collector directory on our hosts
+DEFAULT_TEXTFILE_DIR = "/var/lib/prometheus-node-exporter"
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_prometheus(samples):
+    """
+    Render {fs_uuid: (IoDoneSampler, sample)} in the Prometheus text
+    exposition format.
+    """
+    lines = [
+        "# HELP bcachefs_io_done_bytes_total Bytes of I/O done by a bcachefs device, by direction and data type.",
+        "# TYPE bcachefs_io_done_bytes_total counter",
+    ]
+    for fs_uuid in sorted(samples.keys()):
+        sampler, sample = samples[fs_uuid]
+        # The label sets only change with the layout, so build them once per column
+        column_labels = [f'direction="{section}",type="{_escape_label(metric)}"'
+                         for section, metric in sampler.columns]
+        values = sample["values"]
+        for row, device in enumerate(sampler.devices):
+            # dev="dev-N" keeps series apart when labels repeat or are missing
+            prefix = (f'bcachefs_io_done_bytes_total{{uuid="{_escape_label(fs_uuid)}",'
+                      f'dev="{_escape_label(device["dev"])}",group="{_escape_label(device["group"])}",'
+                      f'device="{_escape_label(device["label"])}",')
+            offset = row * sampler.width
+            lines.extend(f"{prefix}{labels}}} {values[offset + col]}"
+                         for col, labels in enumerate(column_labels))
+    lines.append("# HELP bcachefs_io_metrics_last_refresh_timestamp_seconds When the io_done snapshot was last refreshed.")
+    lines.append("# TYPE bcachefs_io_metrics_last_refresh_timestamp_seconds gauge")
+    lines.append(f"bcachefs_io_metrics_last_refresh_timestamp_seconds {time.time():.3f}")
+    return "\n".join(lines) + "\n"
+
+class MetricsSnapshot:
+    """
+    The rendered /metrics page, refreshed in place.
+
+    Samplers are created once per instance, so a refresh is one pread() per
+    device (plus a listdir to pick up newly mounted filesystems and one per
+    instance to pick up added or removed devices); scrapes only ever read
+    the cached page.
+    """
+
+    def __init__(self, instances=None):
+        self.instances = instances
+        self.samplers = {}
+        self.lock = threading.Lock()
+        self.page = b""
+
+    def refresh(self):
+        current = self.instances or find_bcachefs_instances()
+        for fs_uuid in current:
+            base_dir = f"/sys/fs/bcachefs/{fs_uuid}"
+            sampler = self.samplers.get(fs_uuid)
+            if sampler is not None:
+                try:
+                    dev_names = tuple(sorted(n for n in os.listdir(base_dir) if n.startswith("dev-")))
+                except OSError:
+                    dev_names = ()
+                if dev_names != sampler.dev_names:
+                    # A device was added or removed: rebuild the layout
+                    self.samplers.pop(fs_uuid).close()
+                    sampler = None
+            if sampler is None:
+                self.samplers[fs_uuid] = IoDoneSampler(base_dir)
+        for fs_uuid in list(self.samplers.keys()):
+            if fs_uuid not in current:
+                self.samplers.pop(fs_uuid).close()
+
+        page = format_prometheus({u: (s, s.sample()) for u, s in self.samplers.items()}).encode()
+        with self.lock:
+            self.page = page
+        return page
+
+    def get(self):
+        with self.lock:
+            return self.page
+
+    def close(self):
+        for sampler in self.samplers.values():
+            sampler.close()
+        self.samplers = {}
+
+def write_textfile(page, directory):
+    """Atomically replace <directory>/bcachefs_io.prom for node-exporter's textfile collector."""
+    fd, tmp_path = tempfile.mkstemp(prefix=".bcachefs_io.", suffix=".prom.tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(page)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, os.path.join(directory, "bcachefs_io.prom"))
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+def serve_metrics(snapshot, address, port, refresh):
+    """Serve the snapshot on http://address:port/metrics, refreshing it every `refresh` seconds."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            page = snapshot.get()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+        def log_message(self, format, *args):
+            pass
+
+    snapshot.refresh()
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving bcachefs metrics on http://{address or '0.0.0.0'}:{server.server_port}/metrics")
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(refresh)
+            snapshot.refresh()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        snapshot.close()
+
+# One remote round trip per host: every label, io_done and data_replicas
+# file of every instance as "path:line" lines, plus the host's uptime so
+# rates are timed by the host's clock rather than by SSH latency
+REMOTE_SNAPSHOT_CMD = ("cd /sys/fs/bcachefs 2>/dev/null || exit 0; "
+                       "grep -H . /proc/uptime */dev-*/label */dev-*/io_done */options/data_replicas "
+                       "2>/dev/null; exit 0")
+
+# Reuse one SSH connection per host across polls (ssh -o ControlMaster)
+SSH_OPTIONS = ["-o", "BatchMode=yes", "-o", "ControlMaster=auto",
+               "-o", "ControlPath=~/.ssh/bcachefs-io-metrics-%C", "-o", "ControlPersist=300"]
+
+def parse_remote_snapshot(output):
+    """
+    (instances, uptime) from REMOTE_SNAPSHOT_CMD output. instances maps
+    uuid -> {"replicas": n, "devices": [{"group", "label", "dev": "dev-N",
+    "read": {type: bytes}, "write": {...}}]}; uptime is None if it was not
+    reported.
+    """
+    files = {}
+    for line in output.splitlines():
+        path, sep, content = line.partition(":")
+        if sep:
+            files.setdefault(path, []).append(content)
+
+    instances = {}
+    for path, lines in sorted(files.items()):
+        parts = path.split("/")
+        if len(parts) != 3 or not parts[1].startswith("dev-") or parts[2] != "io_done":
+            continue
+        fs_uuid, dev = parts[0], parts[1]
+        label = files.get(f"{fs_uuid}/{dev}/label")
+        if not label:
+            continue
+        group, dev_label = parse_label(label[0])
+        instance = instances.setdefault(fs_uuid, {"replicas": 1, "devices": []})
+        io_data = parse_io_done_text("\n".join(lines))
+        instance["devices"].append({"group": group, "label": dev_label, "dev": dev,
+                                    "read": io_data["read"], "write": io_data["write"]})
+    for fs_uuid, instance in instances.items():
+        replicas = files.get(f"{fs_uuid}/options/data_replicas")
+        try:
+            instance["replicas"] = max(int(replicas[0].split()[0]), 1)
+        except (TypeError, ValueError, IndexError):
+            pass
+        instance["devices"].sort(key=lambda d: (d["group"], d["label"], d["dev"]))
+    try:
+        uptime = float(files["/proc/uptime"][0].split()[0])
+    except (KeyError, ValueError, IndexError):
+        uptime = None
+    return instances, uptime
+
+def collect_host(host, ssh="ssh", timeout=30):
+    """
+    io_done snapshot of every instance on one host, in a single SSH
+    command. Returns {"host", "time", "uptime", "instances", "error"};
+    time is the host's uptime at the read if "uptime" is true, else local
+    monotonic time.
+    """
+    cmd = shlex.split(ssh) + SSH_OPTIONS + ["-o", f"ConnectTimeout={max(int(timeout), 1)}",
+                                            host, REMOTE_SNAPSHOT_CMD]
+    result = {"host": host, "time": None, "instances": {}, "error": None}
+    started = time.monotonic()
+    try:
+        proc = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        result["error"] = f"timed out after {timeout:g}s"
+        return result
+    except OSError as e:
+        result["error"] = str(e)
+        return result
+    if proc.returncode != 0:
+        result["error"] = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else \
+            f"ssh exited with status {proc.returncode}"
+        return result
+    result["instances"], uptime = parse_remote_snapshot(proc.stdout)
+    # Without the host's uptime, assume the read happened halfway through
+    result["time"] = uptime if uptime is not None else (started + time.monotonic()) / 2
+    result["uptime"] = uptime is not None
+    return result
+
+def collect_fleet(hosts, ssh="ssh", timeout=30, pool=None):
+    """collect_host() for every host at once; results in the order of hosts."""
+    if pool is None:
+        with ThreadPoolExecutor(max_workers=max(min(len(hosts), 64), 1)) as pool:
+            return collect_fleet(hosts, ssh, timeout, pool)
+    return list(pool.map(lambda host: collect_host(host, ssh, timeout), hosts))
+
+def fleet_summary(snapshots, previous=None, top=10):
+    """
+    Merge host snapshots into a fleet view. Without previous, figures are
+    bytes since mount; with the previous round of snapshots, bytes/s
+    between the two (a device that went backwards or is new counts as 0).
+
+    Returns {"tiers": {group: {"read", "write", "hosts": {host: {"read", "write"}}}},
+    "hosts": {host: {"read", "write", "filesystems", "devices", "error"}},
+    "devices": the `top` busiest devices, busiest first}.
+    """
+    before = {}
+    for snapshot in previous or []:
+        for fs_uuid, instance in snapshot["instances"].items():
+            for device in instance["devices"]:
+                before[(snapshot["host"], fs_uuid, device["dev"])] = \
+                    (snapshot["time"], snapshot.get("uptime"), device)
+
+    tiers, hosts, devices = {}, {}, []
+    for snapshot in snapshots:
+        host = snapshot["host"]
+        host_entry = hosts[host] = {"read": 0, "write": 0, "filesystems": len(snapshot["instances"]),
+                                    "devices": 0, "error": snapshot["error"]}
+        for fs_uuid, instance in snapshot["instances"].items():
+            for device in instance["devices"]:
+                figures = {}
+                # Keyed by dev-N: labels need not be unique within a filesystem
+                key = (host, fs_uuid, device["dev"])
+                for section in ("read", "write"):
+                    total = sum(device[section].values())
+                    if previous is not None:
+                        # Only compare times taken from the same clock
+                        if key not in before or before[key][1] != snapshot.get("uptime"):
+                            total = 0
+                        else:
+                            then, _, old = before[key]
+                            elapsed = max(snapshot["time"] - then, 1e-9)
+                            total = max(total - sum(old[section].values()), 0) / elapsed
+                    figures[section] = total
+                host_entry["devices"] += 1
+                tier = tiers.setdefault(device["group"], {"read": 0, "write": 0, "hosts": {}})
+                tier_host = tier["hosts"].setdefault(host, {"read": 0, "write": 0})
+                for section, value in figures.items():
+                    host_entry[section] += value
+                    tier[section] += value
+                    tier_host[section] += value
+                devices.append({"host": host, "fs_uuid": fs_uuid, "group": device["group"],
+                                "device": device["label"], "dev": device["dev"], "read": figures["read"],
+                                "write": figures["write"], "total": figures["read"] + figures["write"]})
+    devices.sort(key=lambda d: -d["total"])
+    return {"tiers": tiers, "hosts": hosts, "devices": devices[:top]}
+
+def print_fleet(summary, rates=False):
+    """Text report of fleet_summary()."""
+    def amount(value):
+        return f"{value / 1e6:.2f} MB/s" if rates else format_bytes(value)
+
+    hosts = summary["hosts"]
+    ok = sum(1 for h in hosts.values() if not h["error"])
+    when = datetime.now().strftime("%H:%M:%S")
+    print(f"=== {when} fleet: {len(hosts)} hosts ({ok} reachable), "
+          f"{sum(h['filesystems'] for h in hosts.values())} filesystems, "
+          f"{sum(h['devices'] for h in hosts.values())} devices "
+          f"({'throughput' if rates else 'since mount'}) ===")
+    print("Tiers:")
+    for group in sorted(summary["tiers"].keys()):
+        tier = summary["tiers"][group]
+        tier_total = tier["read"] + tier["write"]
+        shares = sorted(tier["hosts"].items(), key=lambda x: -(x[1]["read"] + x[1]["write"]))
+        breakdown = ", ".join(f"{host} {(v['read'] + v['write']) / tier_total * 100:.1f}%"
+                              for host, v in shares[:5] if tier_total)
+        if breakdown and len(shares) > 5:
+            breakdown += f", {len(shares) - 5} more hosts"
+        print(f"  {group:<10} read {amount(tier['read']):>12}  write {amount(tier['write']):>12}"
+              + (f"  ({breakdown})" if breakdown else ""))
+    print("Hosts:")
+    for host in sorted(hosts.keys()):
+        entry = hosts[host]
+        if entry["error"]:
+            print(f"  {host:<20} ERROR: {entry['error']}")
+        else:
+            print(f"  {host:<20} read {amount(entry['read']):>12}  write {amount(entry['write']):>12}  "
+                  f"{entry['filesystems']} fs, {entry['devices']} devices")
+    print("Busiest devices:")
+    for rank, device in enumerate(summary["devices"], 1):
+        name = f"{device['group']}.{device['device']} ({device['dev']})"
+        print(f"  {rank:>3}. {device['host']:<20} {name:<24} "
+              f"read {amount(device['read']):>12}  write {amount(device['write']):>12}  "
+              f"fs {device['fs_uuid'][:8]}")
+    print()
+
+def watch_fleet(hosts, ssh="ssh", interval=None, count=None, as_json=False, top=10, timeout=30):
+    """
+    Collect every host concurrently and print the fleet view. Without
+    interval, once with bytes since mount; with interval, bytes/s between
+    rounds `count` times (forever if None).
+    """
+    def report(snapshots, previous):
+        summary = fleet_summary(snapshots, previous, top)
+        if as_json:
+            print(json.dumps(dict(summary, time=time.time(), rates=previous is not None)))
+        else:
+            print_fleet(summary, rates=previous is not None)
+        sys.stdout.flush()
+
+    with ThreadPoolExecutor(max_workers=max(min(len(hosts), 64), 1)) as pool:
+        try:
+            previous = collect_fleet(hosts, ssh, timeout, pool)
+            if interval is None:
+                report(previous, None)
+                return
+            next_tick = time.monotonic()
+            ticks = 0
+            while count is None or ticks < count:
+                next_tick += interval
+                time.sleep(max(next_tick - time.monotonic(), 0))
+                current = collect_fleet(hosts, ssh, timeout, pool)
+                report(current, previous)
+                previous = current
+                ticks += 1
+        except KeyboardInterrupt:
+            pass
+
+def read_hosts_file(path):
+    """Host names from a file, one per line; blank lines and # comments are ignored."""
+    with open(path, "r") as f:
+        return [line.split("#", 1)[0].strip() for line in f if line.split("#", 1)[0].strip()]
+
 def main():
     """Main entry point for the script."""
     parser = argparse.ArgumentParser(description="Analyze bcachefs I/O metrics.")
     parser.add_argument("-u", "--uuid", help="Specific bcachefs UUID to analyze")
     parser.add_argument("-a", "--all", action="store_true", help="Analyze all bcachefs instances")
     parser.add_argument("-j", "--json", action="store_true", help="Output in JSON format")
+    parser.add_argument("-i", "--interval", type=float,
+                        help="Print per-device throughput every INTERVAL seconds instead of totals")
+    parser.add_argument("-c", "--count", type=int,
+                        help="Stop after COUNT intervals (default: run until interrupted)")
+    parser.add_argument("-P", "--percentiles", action="store_true",
+                        help="With --interval, also show rolling 1/5/15 minute p50/p95/p99/max and bursts")
+    parser.add_argument("--burst-factor", type=float, default=4.0,
+                        help="Flag intervals above this multiple of the device's 5 minute median (default: 4)")
+    parser.add_argument("--burst-min", type=float, default=1.0,
+                        help="Ignore bursts below this many MB/s (default: 1)")
+    parser.add_argument("--processes", nargs="?", const="process", choices=("process", "cgroup"),
+                        help="With --interval, attribute each tier's I/O to the busiest processes "
+                             "(or cgroups) with files on the filesystem (implies --interval 1 if not given)")
+    parser.add_argument("--record", metavar="FILE",
+                        help="Also append every sample to the trace FILE (implies --interval 1 if not given)")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="Report from a trace recorded with --record instead of the running system; "
+                             "--interval then sets the reporting window")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="With --replay, pace output at SPEED times real time (default: as fast as possible)")
+    parser.add_argument("--hosts", nargs="+", metavar="HOST",
+                        help="Collect from these hosts over SSH and print a fleet view by tier, host and device")
+    parser.add_argument("--hosts-file", metavar="FILE",
+                        help="Like --hosts, one host per line")
+    parser.add_argument("--ssh", default="ssh",
+                        help="SSH command for --hosts (default: ssh); run as SSH [-o ...] HOST COMMAND")
+    parser.add_argument("--ssh-timeout", type=float, default=30,
+                        help="Seconds to wait for each host (default: 30)")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Busiest devices to list in the fleet view, or processes with --processes (default: 10)")
+    parser.add_argument("--serve", metavar="[ADDR:]PORT",
+                        help="Export io_done counters for Prometheus on http://ADDR:PORT/metrics")
+    parser.add_argument("--textfile", nargs="?", const=DEFAULT_TEXTFILE_DIR, metavar="DIR",
+                        help=f"Write bcachefs_io.prom for node-exporter's textfile collector "
+                             f"(default DIR: {DEFAULT_TEXTFILE_DIR}); with --interval, keep rewriting it")
+    parser.add_argument("--refresh", type=float, default=15,
+                        help="Seconds between snapshot refreshes with --serve (default: 15)")
     args = parser.parse_args()
 
+    if args.replay:
+        try:
+            replay_trace(args.replay, args.interval, max(args.speed, 0), args.json,
+                         args.percentiles, args.burst_factor, args.burst_min * 1e6)
+        except (OSError, ValueError, zlib.error) as e:
+            print(f"Error replaying {args.replay}: {e}")
+            sys.exit(1)
+        return
+
+    if args.hosts or args.hosts_file:
+        hosts = list(args.hosts or [])
+        if args.hosts_file:
+            try:
+                hosts += read_hosts_file(args.hosts_file)
+            except OSError as e:
+                print(f"Error reading {args.hosts_file}: {e}")
+                sys.exit(1)
+        if not hosts:
+            print("No hosts given!")
+            sys.exit(1)
+        watch_fleet(hosts, args.ssh, args.interval, args.count, args.json, max(args.top, 0),
+                    max(args.ssh_timeout, 1))
+        return
+
+    if args.serve or args.textfile:
+        snapshot = MetricsSnapshot([args.uuid] if args.uuid else None)
+        if args.serve:
+            address, _, port = args.serve.rpartition(":")
+            serve_metrics(snapshot, address, int(port), max(args.refresh, 0.1))
+            return
+        try:
+            while True:
+                write_textfile(snapshot.refresh(), args.textfile)
+                if args.interval is None:
+                    break
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            print(f"Error writing metrics to {args.textfile}: {e}")
+            sys.exit(1)
+        finally:
+            snapshot.close()
+        return
+
+    if (args.record or args.processes) and args.interval is None:
+        args.interval = 1.0
+
+    if args.interval is not None:
+        if args.uuid:
+            instances = [args.uuid]
+        else:
+            instances = find_bcachefs_instances()
+            if len(instances) > 1 and not args.all:
+                print("Multiple bcachefs instances found. Please specify one with --uuid or use --all:")
+                for instance in instances:
+                    print(f"  {instance}")
+                sys.exit(1)
+        base_dirs = [f"/sys/fs/bcachefs/{instance}" for instance in instances]
+        if not base_dirs or not all(os.path.isdir(d) for d in base_dirs):
+            print("No bcachefs instances found!")
+            sys.exit(1)
+        writer = None
+        if args.record:
+            try:
+                writer = TraceWriter(args.record)
+            except (OSError, ValueError) as e:
+                print(f"Error recording to {args.record}: {e}")
+                sys.exit(1)
+        try:
+            sample_instances(base_dirs, max(args.interval, 0.01), args.count, args.json,
+                             args.percentiles, args.burst_factor, args.burst_min * 1e6, writer,
+                             args.processes, max(args.top, 0))
+        except OSError as e:
+            print(f"Error sampling {', '.join(instances)}: {e}")
+            sys.exit(1)
+        return
+
     if args.uuid:
         # Analyze a specific bcachefs instance
         base_dir = f"/sys/fs/bcachefs/{args.uuid}"
@@ -209,7 +1717,6 @@ def main():
         analysis = analyze_bcachefs_instance(base_dir)
         if analysis:
             if args.json:
-                import json
                 print(json.dumps(analysis, indent=2))
             else:
                 print_metrics(analysis)
@@ -231,7 +1738,6 @@ def main():
                     print("\n" + "=" * 80 + "\n")
                     
         if args.json:
-            import json
             print(json.dumps(all_analyses, indent=2))
     else:
         # If no specific instance or all flag, check if there's only one instance
@@ -245,7 +1751,6 @@ def main():
             analysis = analyze_bcachefs_instance(base_dir)
             if analysis:
                 if args.json:
-                    import json
                     print(json.dumps(analysis, indent=2))
                 else:
                     print_metrics(analysis)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Stand-in for ssh when testing --hosts without a fleet:
+
+    FAKE_SSH_ROOT=DIR bcachefs-io-metrics --hosts h1,h2 --ssh "fake-ssh.py"
+
+Runs the remote command locally against DIR/HOST, so /sys/fs/bcachefs and
+/proc/uptime are read from DIR/HOST/sys/fs/bcachefs and DIR/HOST/proc/uptime,
+and paths in the output are reported as the remote host would. A HOST
+without a directory is refused like an unreachable host; a DIR/HOST/delay
+file holding a number of seconds delays the reply by that long.
+"""
+
+import os
+import re
+import subprocess
+import sys
+import time
+
+REMOTE_PATHS = ("/sys/fs/bcachefs", "/proc/uptime")
+
+def main():
+    args = sys.argv[1:]
+    # Options as passed by bcachefs-io-metrics: only "-o option" pairs
+    while args[:1] == ["-o"]:
+        args = args[2:]
+    if len(args) < 2:
+        print("usage: fake-ssh.py [-o option]... HOST COMMAND", file=sys.stderr)
+        sys.exit(255)
+    host, command = args[0], " ".join(args[1:])
+
+    root = os.path.join(os.environ.get("FAKE_SSH_ROOT", "."), host)
+    if not os.path.isdir(root):
+        print(f"ssh: connect to host {host} port 22: Connection refused", file=sys.stderr)
+        sys.exit(255)
+    try:
+        with open(os.path.join(root, "delay")) as f:
+            time.sleep(float(f.read()))
+    except FileNotFoundError:
+        pass
+
+    pattern = re.compile("|".join(re.escape(path) for path in REMOTE_PATHS))
+    command = pattern.sub(lambda m: root + m.group(0), command)
+    proc = subprocess.run(["sh", "-c", command], capture_output=True, text=True)
+    sys.stdout.write(proc.stdout.replace(root, ""))
+    sys.stderr.write(proc.stderr.replace(root, ""))
+    sys.exit(proc.returncode)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Tests for --hosts fleet collection, run against fake-ssh.py instead of ssh.
+
+Run with `python3 -m unittest` or pytest from this directory.
+"""
+
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+_spec = importlib.util.spec_from_file_location("bcachefs_io_metrics", os.path.join(HERE, "bcachefs-io-metrics.py"))
+metrics = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(metrics)
+
+FAKE_SSH = f"{sys.executable} {os.path.join(HERE, 'fake-ssh.py')}"
+FS = "0f3c6a2e-1111-2222-3333-444455556666"
+
+def io_done(read, write):
+    """io_done contents with read and write bytes all counted as user data."""
+    return (f"read:\nsb      : 0\nuser    : {read}\n"
+            f"write:\nsb      : 0\nuser    : {write}\n")
+
+class FleetTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        os.environ["FAKE_SSH_ROOT"] = self.tmp.name
+        self.addCleanup(os.environ.pop, "FAKE_SSH_ROOT", None)
+
+    def _write(self, host, path, content):
+        path = os.path.join(self.tmp.name, host, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def add_host(self, host, devices, uptime=1000.0, replicas=2):
+        """devices: [(label, read bytes, write bytes)] as dev-0, dev-1, ..."""
+        self._write(host, "proc/uptime", f"{uptime:.2f} 4000.00\n")
+        fs_dir = f"sys/fs/bcachefs/{FS}"
+        self._write(host, f"{fs_dir}/options/data_replicas", f"{replicas}\n")
+        for i, (label, read, write) in enumerate(devices):
+            self._write(host, f"{fs_dir}/dev-{i}/label", f"{label}\n")
+            self._write(host, f"{fs_dir}/dev-{i}/io_done", io_done(read, write))
+
+    def collect(self, hosts, timeout=10):
+        return metrics.collect_fleet(hosts, ssh=FAKE_SSH, timeout=timeout)
+
+    def test_grep_output_is_parsed(self):
+        self.add_host("h1", [("ssd.ssd0", 100, 200), ("hdd.hdd0", 300, 400)], uptime=1234.5)
+        snapshot, = self.collect(["h1"])
+        self.assertIsNone(snapshot["error"])
+        self.assertTrue(snapshot["uptime"])
+        self.assertEqual(snapshot["time"], 1234.5)
+        instance = snapshot["instances"][FS]
+        self.assertEqual(instance["replicas"], 2)
+        self.assertEqual([(d["group"], d["label"], d["dev"]) for d in instance["devices"]],
+                         [("hdd", "hdd0", "dev-1"), ("ssd", "ssd0", "dev-0")])
+        self.assertEqual(instance["devices"][1]["read"], {"sb": 0, "user": 100})
+        self.assertEqual(instance["devices"][1]["write"], {"sb": 0, "user": 200})
+
+    def test_content_with_colons(self):
+        output = ("/proc/uptime:12.50 40.00\n"
+                  f"{FS}/dev-0/label:ssd.ssd0\n"
+                  f"{FS}/dev-0/io_done:read:\n"
+                  f"{FS}/dev-0/io_done:user    : 5\n"
+                  f"{FS}/dev-0/io_done:write:\n"
+                  f"{FS}/dev-0/io_done:user    : 7\n"
+                  f"{FS}/dev-1/io_done:read:\n")
+        instances, uptime = metrics.parse_remote_snapshot(output)
+        self.assertEqual(uptime, 12.5)
+        # dev-1 has no label and is skipped
+        device, = instances[FS]["devices"]
+        self.assertEqual((device["dev"], device["read"], device["write"]),
+                         ("dev-0", {"user": 5}, {"user": 7}))
+        self.assertEqual(instances[FS]["replicas"], 1)
+
+    def test_unreachable_host(self):
+        self.add_host("h1", [("ssd.ssd0", 100, 200)])
+        up, down = self.collect(["h1", "down"])
+        self.assertIsNone(up["error"])
+        self.assertIn("Connection refused", down["error"])
+        summary = metrics.fleet_summary([up, down])
+        self.assertEqual(summary["hosts"]["down"]["error"], down["error"])
+        self.assertEqual(summary["hosts"]["down"]["devices"], 0)
+        self.assertEqual(summary["hosts"]["h1"]["devices"], 1)
+
+    def test_timeout(self):
+        self.add_host("slow", [("ssd.ssd0", 100, 200)])
+        self._write("slow", "delay", "5\n")
+        snapshot, = self.collect(["slow"], timeout=0.5)
+        self.assertEqual(snapshot["error"], "timed out after 0.5s")
+        self.assertEqual(snapshot["instances"], {})
+
+    def test_rates(self):
+        self.add_host("h1", [("ssd.ssd0", 1000, 2000), ("hdd.hdd0", 0, 0)], uptime=100.0)
+        previous = self.collect(["h1"])
+        self.add_host("h1", [("ssd.ssd0", 3000, 2000), ("hdd.hdd0", 0, 5000)], uptime=110.0)
+        current = self.collect(["h1"])
+        summary = metrics.fleet_summary(current, previous)
+        self.assertEqual(summary["tiers"]["ssd"]["read"], 200)
+        self.assertEqual(summary["tiers"]["hdd"]["write"], 500)
+        self.assertEqual(summary["hosts"]["h1"]["read"], 200)
+        self.assertEqual(summary["hosts"]["h1"]["write"], 500)
+        self.assertEqual([(d["dev"], d["total"]) for d in summary["devices"]],
+                         [("dev-1", 500), ("dev-0", 200)])
+
+    def test_devices_sharing_a_label_are_kept_apart(self):
+        self.add_host("h1", [("hdd.hdd", 0, 0), ("hdd.hdd", 0, 0)], uptime=100.0)
+        previous = self.collect(["h1"])
+        self.add_host("h1", [("hdd.hdd", 0, 1000), ("hdd.hdd", 0, 3000)], uptime=110.0)
+        current = self.collect(["h1"])
+        summary = metrics.fleet_summary(current, previous)
+        self.assertEqual(summary["hosts"]["h1"]["devices"], 2)
+        self.assertEqual([(d["dev"], d["write"]) for d in summary["devices"]],
+                         [("dev-1", 300), ("dev-0", 100)])
+        self.assertEqual(summary["tiers"]["hdd"]["write"], 400)
+
+if __name__ == "__main__":
+    unittest.main()